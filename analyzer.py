@@ -3,34 +3,670 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 import hashlib
-import json
-import librosa
+import importlib.util
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
 import numpy as np
-import soundfile as sf
 import mido
-from basic_pitch.inference import predict_and_save
-from basic_pitch import ICASSP_2022_MODEL_PATH
+
+# librosa, soundfile, soxr and basic_pitch (which pulls in TensorFlow) are imported
+# inside the functions that use them, so the web server can import this module
+# without loading the analysis stack. Only the analysis pool processes pay for it.
+
+# Same values as basic_pitch.constants (importing that package loads TensorFlow)
+AUDIO_SAMPLE_RATE = 22050
+FFT_HOP = 256
+AUDIO_N_SAMPLES = AUDIO_SAMPLE_RATE * 2 - FFT_HOP
+
+# User defined threshold for "valid" practice
+MIN_VELOCITY = 70
+# Notes closer than this (seconds) belong to the same practice interval
+GAP_THRESHOLD = 2.0
+# Padding (seconds) added around each merged interval
+INTERVAL_PADDING = 0.5
+
+# Basic Pitch note extraction settings (same defaults as basic_pitch.inference.predict)
+ONSET_THRESHOLD = 0.5
+FRAME_THRESHOLD = 0.3
+MINIMUM_NOTE_LENGTH_MS = 127.70
+# Model windows overlap by this many output frames
+N_OVERLAPPING_FRAMES = 30
+# Model-rate samples between consecutive model windows
+MODEL_HOP_SAMPLES = AUDIO_N_SAMPLES - N_OVERLAPPING_FRAMES * FFT_HOP
+
+# Silence gating: RMS frames more than SILENCE_TOP_DB below the loudest frame are
+# silent. Active spans get SILENCE_PADDING seconds on each side, and spans closer
+# than SILENCE_MIN_GAP seconds are transcribed as one.
+SILENCE_TOP_DB = 60
+SILENCE_PADDING = 1.0
+SILENCE_MIN_GAP = 5.0
+# RMS frames for silence gating (librosa.feature.rms defaults), computed in blocks of RMS_BLOCK_FRAMES
+RMS_FRAME_LENGTH = 2048
+RMS_HOP_LENGTH = 512
+RMS_BLOCK_FRAMES = 4096
+
+# Recordings longer than this (seconds) are analyzed block by block (see StreamingAnalysis)
+STREAMING_MIN_DURATION = 20 * 60
+# Streaming mode: native-rate block size read from disk, transcription chunk
+# length and the context decoded on either side of each chunk (seconds)
+STREAM_BLOCK_SECONDS = 10
+STREAM_CHUNK_SECONDS = 60
+STREAM_CONTEXT_SECONDS = 10
+
+# Live recordings (WAV files still being written, see follow_recording): how often
+# the file is checked for new samples, how often a provisional result is sent, and
+# how long the file must stop growing to count as finished (seconds)
+LIVE_POLL_SECONDS = 2
+LIVE_UPDATE_SECONDS = 30
+LIVE_IDLE_SECONDS = 15
+# Bytes read from the start of a file to find its data chunk
+WAV_HEADER_READ = 64 * 1024
+
+# Quick fingerprint: file size plus the first and last FINGERPRINT_BLOCK bytes
+FINGERPRINT_BLOCK = 64 * 1024
+# Read size (and file buffer size) for content hashing
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Analysis cache: raw transcription output (notes and model posteriors) per file
+# hash, so re-ingesting a file skips decoding and inference. Bump ANALYZER_VERSION
+# whenever decoding, silence gating or the transcription itself changes.
+ANALYZER_VERSION = 1
+MODEL_NAME = 'icassp_2022'
+
+# Inference runtime for the Basic Pitch model: 'tf' (TensorFlow SavedModel),
+# 'tflite' (tflite_runtime, or TensorFlow's interpreter if that isn't installed)
+# or 'onnx' (onnxruntime). Thread counts of 0 keep the runtime's default (all
+# cores); with several analysis workers per machine, set them so that
+# workers * threads stays within the core count.
+MODEL_BACKEND = os.environ.get('SONATA_MODEL_BACKEND', 'tf').lower()
+INTRA_OP_THREADS = int(os.environ.get('SONATA_INTRA_OP_THREADS', '0'))
+INTER_OP_THREADS = int(os.environ.get('SONATA_INTER_OP_THREADS', '0'))
+# Model file in basic_pitch/saved_models/icassp_2022 and the runtime module each backend loads it with
+MODEL_BACKENDS = {
+    'tf': ('nmp', 'tensorflow'),
+    'tflite': ('nmp.tflite', 'tflite_runtime'),
+    'onnx': ('nmp.onnx', 'onnxruntime'),
+}
+
+# Waveform envelopes are stored as a pyramid of levels of detail (envelope rates in
+# Hz, coarsest first), each level the max of the next finer one over rate-ratio
+# windows. Every rate must divide WAVEFORM_RATE, the rate the envelope is computed
+# at. Adding 1000 gives a 1 kHz level for close zooms (+3.6 MB per hour of audio).
+WAVEFORM_LEVELS = (1, 10, 100)
+WAVEFORM_RATE = WAVEFORM_LEVELS[-1]
+# Single-level blob (version 1, also what the waveform endpoint serves): header
+# (format version, envelope rate in Hz, sample count) followed by one uint8 per
+# sample (amplitude * 255), little endian.
+WAVEFORM_FORMAT_VERSION = 1
+WAVEFORM_HEADER = struct.Struct('<BHI')
+# Pyramid blob (version 2): header (format version, level count), one (rate, sample
+# count) entry per level, then every level's uint8 samples in the same order.
+WAVEFORM_PYRAMID_VERSION = 2
+WAVEFORM_PYRAMID_HEADER = struct.Struct('<BB')
+WAVEFORM_LEVEL_HEADER = struct.Struct('<HI')
+
+if MODEL_BACKEND not in MODEL_BACKENDS:
+    raise ValueError(f"SONATA_MODEL_BACKEND must be one of {', '.join(MODEL_BACKENDS)}, not {MODEL_BACKEND!r}")
+
+# basic_pitch imports TensorFlow whenever it is installed, even when the model runs
+# on another runtime. If that runtime is available, hide TensorFlow from this process
+# so the worker doesn't pay for loading it.
+if MODEL_BACKEND != 'tf' and importlib.util.find_spec(MODEL_BACKENDS[MODEL_BACKEND][1]) is not None:
+    sys.modules.setdefault('tensorflow', None)
+
+# Process-wide Basic Pitch model (loaded once, shared by every analysis in this process)
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """Returns the shared Basic Pitch model for MODEL_BACKEND, loading it on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_model(MODEL_BACKEND, INTRA_OP_THREADS, INTER_OP_THREADS)
+    return _model
+
+def model_path(backend):
+    """Path of the bundled ICASSP 2022 model file for a backend (without importing basic_pitch)."""
+    package_dir = importlib.util.find_spec('basic_pitch').submodule_search_locations[0]
+    return os.path.join(package_dir, 'saved_models', MODEL_NAME, MODEL_BACKENDS[backend][0])
+
+def load_model(backend, intra_op_threads=0, inter_op_threads=0):
+    """
+    Loads the model on the given runtime. Every backend has the same interface as
+    basic_pitch.inference.Model: predict(x) with x of shape (1, AUDIO_N_SAMPLES, 1)
+    returns {"note", "onset", "contour"} arrays.
+    """
+    path = model_path(backend)
+    if backend == 'tf':
+        import tensorflow as tf
+        from basic_pitch.inference import Model
+
+        # Only takes effect before TensorFlow runs its first op
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        return Model(path)
+    if backend == 'tflite':
+        return TFLiteModel(path, intra_op_threads)
+    return ONNXModel(path, intra_op_threads, inter_op_threads)
+
+class TFLiteModel:
+    """Basic Pitch on the TFLite interpreter. TFLite has no inter-op pool, only num_threads."""
+    def __init__(self, path, num_threads=0):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(path, num_threads=num_threads or None)
+        self.runner = self.interpreter.get_signature_runner()
+
+    def predict(self, x):
+        return self.runner(input_2=x)
+
+class ONNXModel:
+    """Basic Pitch on onnxruntime's CPU provider."""
+    OUTPUTS = {
+        "note": "StatefulPartitionedCall:1",
+        "onset": "StatefulPartitionedCall:2",
+        "contour": "StatefulPartitionedCall:0",
+    }
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def predict(self, x):
+        outputs = self.session.run(list(self.OUTPUTS.values()), {"serving_default_input_2:0": x})
+        return dict(zip(self.OUTPUTS, outputs))
+
+def warm_up_model():
+    """
+    Loads the model and runs one silent window through it, so the first
+    real recording doesn't pay for graph tracing.
+    """
+    model = get_model()
+    model.predict(np.zeros((1, AUDIO_N_SAMPLES, 1), dtype=np.float32))
+    return model
+
+# Queue for messages from this analysis process to the web process (see init_worker)
+_events = None
+
+def init_worker(events=None):
+    """
+    Initializer for analysis pool processes: load and warm the model before the
+    first file. `events` is a multiprocessing queue that report_event writes to.
+    """
+    global _events
+    _events = events
+    warm_up_model()
+
+def report_event(event, **fields):
+    """Sends {"event": event, **fields} to the web process, if this process was given an event queue."""
+    if _events is not None:
+        _events.put({"event": event, **fields})
+
+# Minimum seconds between two progress events for the same file and stage
+PROGRESS_INTERVAL = 1.0
+_last_progress = (None, 0.0)
+
+def report_progress(file_path, stage, fraction):
+    """
+    Sends a `stage` event (such as "transcribing") with the file's percent
+    done, throttled to one per PROGRESS_INTERVAL (the start and end always go out).
+    """
+    global _last_progress
+    if _events is None:
+        return
+    now = time.monotonic()
+    key = (file_path, stage)
+    if _last_progress[0] == key and 0 < fraction < 1 and now - _last_progress[1] < PROGRESS_INTERVAL:
+        return
+    _last_progress = (key, now)
+    report_event(stage, file=os.path.basename(file_path), percent=round(100 * min(max(fraction, 0.0), 1.0), 1))
 
 def get_file_hash(file_path):
     """Calculates SHA-256 hash of a file."""
     sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
+        for byte_block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
+def get_quick_hash(file_path):
+    """
+    SHA-256 over the file size and its first and last FINGERPRINT_BLOCK bytes.
+    Identical files always match; files that match still need get_file_hash to confirm.
+    """
+    size = os.path.getsize(file_path)
+    quick_hash = hashlib.sha256(str(size).encode())
+    with open(file_path, "rb") as f:
+        quick_hash.update(f.read(FINGERPRINT_BLOCK))
+        if size > FINGERPRINT_BLOCK:
+            f.seek(max(FINGERPRINT_BLOCK, size - FINGERPRINT_BLOCK))
+            quick_hash.update(f.read(FINGERPRINT_BLOCK))
+    return quick_hash.hexdigest()
+
+class HashingReader:
+    """
+    Read-only file object that computes the file's SHA-256 from the bytes a
+    decoder reads through it, so a recording is read from disk only once.
+    Bytes are hashed in file order; whatever the decoder skips over or never
+    reads (e.g. trailing metadata chunks) is read and hashed by hexdigest().
+    Equal to get_file_hash(file_path).
+    """
+
+    def __init__(self, file_path):
+        self.name = file_path
+        self._file = open(file_path, "rb", buffering=HASH_BLOCK_SIZE)
+        self._hash = hashlib.sha256()
+        self._hashed = 0 # Bytes [0, _hashed) are in the hash
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        pos = self._file.tell()
+        data = self._file.read(size)
+        self._update(pos, memoryview(data))
+        return data
+
+    def readinto(self, buffer):
+        pos = self._file.tell()
+        n = self._file.readinto(buffer)
+        self._update(pos, memoryview(buffer).cast("B")[:n])
+        return n
+
+    def hexdigest(self):
+        self._catch_up(os.fstat(self._file.fileno()).st_size)
+        return self._hash.hexdigest()
+
+    def _update(self, pos, data):
+        if pos > self._hashed:
+            self._catch_up(pos)
+        if pos + len(data) > self._hashed:
+            self._hash.update(data[self._hashed - pos:])
+            self._hashed = pos + len(data)
+
+    def _catch_up(self, target):
+        """Hashes the bytes between what was hashed so far and `target`, restoring the read position."""
+        if target <= self._hashed:
+            return
+        pos = self._file.tell()
+        self._file.seek(self._hashed)
+        while self._hashed < target:
+            data = self._file.read(min(HASH_BLOCK_SIZE, target - self._hashed))
+            if not data:
+                break
+            self._hash.update(data)
+            self._hashed += len(data)
+        self._file.seek(pos)
+
+def load_audio(file_path):
+    """
+    Decodes the file once and returns (y, sr, y_model): the mono signal at
+    its native rate, and the same signal resampled to the transcription
+    model's rate. Every analysis stage works from these two buffers.
+    `file_path` may also be a file object (e.g. a HashingReader).
+    """
+    import librosa
+
+    y, sr = librosa.load(file_path, sr=None)
+    if sr == AUDIO_SAMPLE_RATE:
+        y_model = y
+    else:
+        y_model = librosa.resample(y, orig_sr=sr, target_sr=AUDIO_SAMPLE_RATE)
+    return y, sr, y_model
+
+def load_audio_hashed(file_path):
+    """load_audio plus the file's SHA-256, computed from the same read of the file."""
+    try:
+        with HashingReader(file_path) as reader:
+            y, sr, y_model = load_audio(reader)
+            return y, sr, y_model, reader.hexdigest()
+    except Exception:
+        # Not a format soundfile can decode; librosa's fallback decoder needs a path
+        y, sr, y_model = load_audio(file_path)
+        return y, sr, y_model, get_file_hash(file_path)
+
+def run_model(y_model, model=None, progress=None):
+    """
+    Runs Basic Pitch over a mono buffer at AUDIO_SAMPLE_RATE and returns the
+    note and onset posteriors. Mirrors basic_pitch.inference.run_inference,
+    minus the file decode and the pitch contour (notes are made without pitch bends).
+    `progress`, if given, is called with the fraction of windows done.
+    """
+    if model is None:
+        model = get_model()
+
+    from basic_pitch.inference import unwrap_output
+
+    output = {"note": [], "onset": []}
+    n_windows = -(-(N_OVERLAPPING_FRAMES * FFT_HOP // 2 + len(y_model)) // MODEL_HOP_SAMPLES)
+    for i, window in enumerate(model_windows(y_model)):
+        prediction = model.predict(window[np.newaxis])
+        for k in output:
+            output[k].append(prediction[k])
+        if progress:
+            progress((i + 1) / n_windows)
+
+    return {
+        k: unwrap_output(np.concatenate(v), len(y_model), N_OVERLAPPING_FRAMES)
+        for k, v in output.items()
+    }
+
+def model_windows(y_model):
+    """
+    The (AUDIO_N_SAMPLES, 1) windows basic_pitch.inference.window_audio_file
+    yields for y_model with half an overlap of zeros in front, built one at a
+    time rather than from a zero-padded copy of the whole buffer.
+    """
+    lead = N_OVERLAPPING_FRAMES * FFT_HOP // 2
+    for i in range(0, lead + len(y_model), MODEL_HOP_SAMPLES):
+        window = np.zeros(AUDIO_N_SAMPLES, dtype=np.float32)
+        start = i - lead
+        samples = y_model[max(0, start):start + AUDIO_N_SAMPLES]
+        window[max(0, -start):max(0, -start) + len(samples)] = samples
+        yield window[:, np.newaxis]
+
+def notes_from_model_output(model_output, onset_threshold=ONSET_THRESHOLD, frame_threshold=FRAME_THRESHOLD,
+                            minimum_note_length_ms=MINIMUM_NOTE_LENGTH_MS):
+    """Extracts note arrays from raw model posteriors (by default with the current thresholds)."""
+    from basic_pitch.note_creation import output_to_notes_polyphonic, model_frames_to_time
+
+    frames = model_output["note"]
+    min_note_len = int(np.round(minimum_note_length_ms / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    estimated_notes = output_to_notes_polyphonic(
+        frames,
+        model_output["onset"],
+        onset_thresh=onset_threshold,
+        frame_thresh=frame_threshold,
+        min_note_len=min_note_len,
+        infer_onsets=True,
+        max_freq=None,
+        min_freq=None,
+    )
+    if not estimated_notes:
+        return empty_notes()
+
+    times_s = model_frames_to_time(frames.shape[0])
+    start_idx, end_idx, pitch, amplitude = (np.asarray(col) for col in zip(*estimated_notes))
+    return {
+        "start": times_s[start_idx].astype(np.float64),
+        "end": times_s[end_idx].astype(np.float64),
+        "pitch": pitch.astype(np.int16),
+        # Same rounding pretty_midi uses when writing the MIDI file
+        "velocity": np.round(127 * amplitude.astype(np.float64)).astype(np.int16),
+    }
+
+def transcribe(y_model, model=None, offset=0.0, posteriors=None, progress=None):
+    """
+    Transcribes a mono buffer at AUDIO_SAMPLE_RATE into note arrays.
+    `offset` (seconds) is added to note times, for buffers cut from a longer recording.
+    If `posteriors` is a list, the model output is appended to it (see pack_posteriors).
+    """
+    if len(y_model) == 0:
+        return empty_notes()
+    model_output = run_model(y_model, model, progress)
+    if posteriors is not None:
+        posteriors.append(pack_posteriors(model_output, offset))
+    notes = notes_from_model_output(model_output)
+    if offset:
+        notes["start"] += offset
+        notes["end"] += offset
+    return notes
+
+def pack_posteriors(model_output, offset=0.0):
+    """
+    One transcribed segment for the analysis cache: the note and onset posteriors
+    as float16, their start time in the recording, and the onset range whose
+    notes count (the whole segment unless it was run with context, see StreamingAnalysis).
+    """
+    return {
+        "offset": float(offset),
+        "note": model_output["note"].astype(np.float16),
+        "onset": model_output["onset"].astype(np.float16),
+        "keep": (-np.inf, np.inf),
+    }
+
+def notes_from_posteriors(posteriors, **thresholds):
+    """
+    Re-extracts note arrays from packed posteriors (see pack_posteriors), e.g.
+    from the analysis cache with new thresholds, without running the model.
+    Keyword arguments are passed to notes_from_model_output.
+    """
+    parts = []
+    for seg in posteriors:
+        model_output = {"note": seg["note"].astype(np.float32), "onset": seg["onset"].astype(np.float32)}
+        notes = notes_from_model_output(model_output, **thresholds)
+        notes["start"] += seg["offset"]
+        notes["end"] += seg["offset"]
+        keep_start, keep_end = seg["keep"]
+        keep = (notes["start"] >= keep_start) & (notes["start"] < keep_end)
+        parts.append({k: v[keep] for k, v in notes.items()})
+    return concat_notes(parts)
+
+def frame_rms(y, hop_length=RMS_HOP_LENGTH, frame_length=RMS_FRAME_LENGTH):
+    """
+    Same values as librosa.feature.rms(y=y, ...)[0] (centered, zero padded),
+    computed RMS_BLOCK_FRAMES frames at a time. librosa pads a copy of the
+    whole signal and squares every frame at once, which takes about
+    frame_length / hop_length times the signal's memory.
+    """
+    import librosa
+
+    pad = frame_length // 2
+    n_frames = 1 + len(y) // hop_length
+    rms = np.empty(n_frames, dtype=np.float32)
+    for f0 in range(0, n_frames, RMS_BLOCK_FRAMES):
+        f1 = min(n_frames, f0 + RMS_BLOCK_FRAMES)
+        a = f0 * hop_length - pad
+        b = (f1 - 1) * hop_length - pad + frame_length
+        block = y[max(0, a):min(len(y), b)]
+        if a < 0 or b > len(y):
+            block = np.pad(block, (max(0, -a), max(0, b - len(y))))
+        rms[f0:f1] = librosa.feature.rms(y=block, frame_length=frame_length, hop_length=hop_length, center=False)[0]
+    return rms
+
+def find_active_spans(rms_db, frame_seconds):
+    """
+    Returns (start_s, end_s) spans where rms_db (one value per frame_seconds,
+    relative to the loudest frame) is above -SILENCE_TOP_DB, padded and merged.
+    """
+    active = np.concatenate([[0], (rms_db > -SILENCE_TOP_DB).astype(np.int8), [0]])
+    edges = np.flatnonzero(np.diff(active))
+    if len(edges) == 0:
+        return []
+    starts = np.maximum(0.0, edges[0::2] * frame_seconds - SILENCE_PADDING)
+    ends = edges[1::2] * frame_seconds + SILENCE_PADDING
+
+    # Runs are sorted and disjoint, so a span begins wherever the gap to the previous run is large enough
+    new_span = np.concatenate([[True], starts[1:] - ends[:-1] > SILENCE_MIN_GAP])
+    first = np.flatnonzero(new_span)
+    last = np.concatenate([first[1:] - 1, [len(starts) - 1]])
+    return list(zip(starts[first].tolist(), ends[last].tolist()))
+
+def transcribe_spans(y_model, spans, model=None, offset=0.0, posteriors=None, progress=None):
+    """
+    Transcribes only the given (start_s, end_s) spans of a model-rate buffer
+    and returns their notes on the buffer's timeline (plus `offset`).
+    Spans are widened to whole model windows so results match a full pass.
+    `progress`, if given, is called with the fraction of the spans' audio done.
+    """
+    bounds = []
+    for start_s, end_s in spans:
+        a = int(start_s * AUDIO_SAMPLE_RATE // MODEL_HOP_SAMPLES) * MODEL_HOP_SAMPLES
+        b = -int(-end_s * AUDIO_SAMPLE_RATE // MODEL_HOP_SAMPLES) * MODEL_HOP_SAMPLES
+        a, b = max(0, a), min(len(y_model), b)
+        if a >= b:
+            continue
+        if bounds and a <= bounds[-1][1]:
+            bounds[-1][1] = max(bounds[-1][1], b)
+        else:
+            bounds.append([a, b])
+
+    total = sum(b - a for a, b in bounds)
+    parts = []
+    done = 0
+    for a, b in bounds:
+        span_progress = None
+        if progress:
+            span_progress = lambda fraction, done=done, length=b - a: progress((done + fraction * length) / total)
+        parts.append(transcribe(y_model[a:b], model, offset=offset + a / AUDIO_SAMPLE_RATE, posteriors=posteriors,
+                                progress=span_progress))
+        done += b - a
+    return concat_notes(parts)
+
 def generate_waveform_data(y, sr):
-    """Generates a compressed waveform envelope (100Hz)."""
-    target_sr = 100
+    """Generates the waveform envelope pyramid (WAVEFORM_LEVELS) as a binary blob (see encode_waveform)."""
+    target_sr = WAVEFORM_RATE
     hop_length = sr // target_sr
     if hop_length <= 0:
         hop_length = 1
     
-    # Calculate max amplitude for each window
-    envelope = [float(np.max(np.abs(y[i:i+hop_length]))) for i in range(0, len(y), hop_length)]
-    return json.dumps(envelope)
+    return encode_waveform(waveform_envelope(y, hop_length), target_sr)
+
+def waveform_envelope(y, hop_length):
+    """Max |y| over consecutive windows of hop_length samples (last window may be partial)."""
+    n_full = len(y) // hop_length
+    frames = y[:n_full * hop_length].reshape(n_full, hop_length)
+    # max|x| == max(|max x|, |min x|); reducing first avoids an abs() copy of the whole signal
+    envelope = np.maximum(np.abs(frames.max(axis=1, initial=0)), np.abs(frames.min(axis=1, initial=0)))
+    tail = y[n_full * hop_length:]
+    if len(tail):
+        envelope = np.append(envelope, max(abs(tail.max()), abs(tail.min())))
+    return envelope
+
+def _quantize_waveform(envelope):
+    return np.clip(np.round(np.asarray(envelope, dtype=np.float32) * 255), 0, 255).astype(np.uint8)
+
+def encode_waveform(envelope, rate=WAVEFORM_RATE):
+    """
+    Packs a normalized (0..1) envelope at `rate` Hz as a pyramid blob: the
+    envelope itself plus every coarser WAVEFORM_LEVELS rate that divides it,
+    quantized to uint8.
+    """
+    envelope = np.asarray(envelope, dtype=np.float32)
+    rates = [r for r in WAVEFORM_LEVELS if r < rate and rate % r == 0] + [rate]
+    # The envelope is non-negative, so a max|x| envelope of it is a plain windowed max
+    levels = [_quantize_waveform(waveform_envelope(envelope, rate // r)) for r in rates[:-1]] + [_quantize_waveform(envelope)]
+
+    blob = [WAVEFORM_PYRAMID_HEADER.pack(WAVEFORM_PYRAMID_VERSION, len(rates))]
+    blob += [WAVEFORM_LEVEL_HEADER.pack(r, len(level)) for r, level in zip(rates, levels)]
+    blob += [level.tobytes() for level in levels]
+    return b"".join(blob)
+
+def encode_waveform_level(samples, rate):
+    """Packs one level's uint8 samples as a single-level (version 1) blob."""
+    return WAVEFORM_HEADER.pack(WAVEFORM_FORMAT_VERSION, rate, len(samples)) + np.asarray(samples, dtype=np.uint8).tobytes()
+
+def waveform_levels(blob):
+    """
+    Unpacks a waveform blob (pyramid, or a single-level blob from before
+    pyramids) into [(rate, uint8 samples)], coarsest first.
+    """
+    version = blob[0]
+    if version == WAVEFORM_FORMAT_VERSION:
+        _, rate, count = WAVEFORM_HEADER.unpack_from(blob)
+        return [(rate, np.frombuffer(blob, dtype=np.uint8, count=count, offset=WAVEFORM_HEADER.size))]
+    if version != WAVEFORM_PYRAMID_VERSION:
+        raise ValueError(f"Unsupported waveform format version {version}")
+
+    _, n_levels = WAVEFORM_PYRAMID_HEADER.unpack_from(blob)
+    offset = WAVEFORM_PYRAMID_HEADER.size + n_levels * WAVEFORM_LEVEL_HEADER.size
+    levels = []
+    for i in range(n_levels):
+        rate, count = WAVEFORM_LEVEL_HEADER.unpack_from(blob, WAVEFORM_PYRAMID_HEADER.size + i * WAVEFORM_LEVEL_HEADER.size)
+        levels.append((rate, np.frombuffer(blob, dtype=np.uint8, count=count, offset=offset)))
+        offset += count
+    return levels
 
-def analyze_audio(file_path, output_midi_dir):
+def waveform_pyramid(blob):
+    """A pyramid blob of the same envelope: single-level blobs get their coarser levels built."""
+    if blob[0] == WAVEFORM_PYRAMID_VERSION:
+        return blob
+    rate, envelope = decode_waveform(blob)
+    return encode_waveform(envelope, rate)
+
+def decode_waveform(blob):
+    """Inverse of encode_waveform. Returns (rate, float32 envelope in 0..1) of the finest level."""
+    rate, samples = waveform_levels(blob)[-1]
+    return rate, samples.astype(np.float32) / 255
+
+def select_waveform_level(blob, width, start=0.0, end=None):
+    """
+    Picks the coarsest level with at least `width` samples between `start` and
+    `end` seconds (the finest level if none has) and cuts that range out of it.
+    Returns (rate, index of the first sample, uint8 samples).
+    """
+    levels = waveform_levels(blob)
+    rate, samples = levels[-1]
+    if end is None:
+        end = len(samples) / rate
+    for level_rate, level_samples in levels:
+        if (end - start) * level_rate >= width:
+            rate, samples = level_rate, level_samples
+            break
+    first = max(0, int(np.floor(start * rate)))
+    last = min(len(samples), int(np.ceil(end * rate)))
+    return rate, first, samples[first:max(first, last)]
+
+class StageTimer:
+    """
+    Wall and CPU seconds per named stage, in `stages` as {name: {"wall", "cpu"}}.
+    Stages may nest: time inside an inner stage is charged to it only, not to
+    the enclosing one. CPU time comes from `cpu_clock`: by default the whole
+    process's (including model threads); time.thread_time for stages timed
+    in a process that does other work, such as the web server.
+    """
+
+    def __init__(self, cpu_clock=time.process_time):
+        self.cpu_clock = cpu_clock
+        self.stages = {}
+        self._stack = []
+        self._mark = None
+
+    @contextmanager
+    def stage(self, name):
+        self._charge()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge()
+            self._stack.pop()
+
+    def _charge(self):
+        now = (time.perf_counter(), self.cpu_clock())
+        if self._stack:
+            totals = self.stages.setdefault(self._stack[-1], {"wall": 0.0, "cpu": 0.0})
+            totals["wall"] += now[0] - self._mark[0]
+            totals["cpu"] += now[1] - self._mark[1]
+        self._mark = now
+
+def analyze_audio(file_path, output_midi_dir, streaming=None, cache_dir=None):
     """
     Analyzes the audio file:
     1. Load audio
@@ -39,174 +675,795 @@ def analyze_audio(file_path, output_midi_dir):
     4. Convert to MIDI
     5. Calculate stats
     6. Return analysis data
+
+    Recordings longer than STREAMING_MIN_DURATION are analyzed block by
+    block (see analyze_audio_streaming) unless `streaming` says otherwise.
+    With a `cache_dir`, a cached analysis of the same content is reused and
+    new analyses are added to the cache (see load_cached_analysis).
+    The result's "timings" holds wall/CPU seconds per stage (see StageTimer).
     """
+    import librosa
+    import soundfile as sf
+
     if not os.path.exists(file_path):
         return None
 
-    # 1. Load Audio
-    y, sr = librosa.load(file_path, sr=None)
-    y_norm = y / (np.max(np.abs(y)) + 1e-9)
-    duration_orig = float(len(y) / sr)
+    timer = StageTimer()
+    if cache_dir:
+        with timer.stage("cache"):
+            cached = load_cached_analysis(cache_dir, file_path)
+        if cached is not None:
+            print(f"Using cached analysis for {os.path.basename(file_path)}")
+            return _build_result(file_path, cached["hash"], output_midi_dir, cached["duration"], cached["waveform"], cached["notes"],
+                                 timer=timer)
+
+    if streaming is None:
+        try:
+            streaming = sf.info(file_path).duration > STREAMING_MIN_DURATION
+        except Exception:
+            streaming = False # Not a format soundfile can stream; librosa will handle it
+    if streaming:
+        return analyze_audio_streaming(file_path, output_midi_dir, cache_dir, timer)
+
+    # 1. Load Audio (single read of the file: decode and content hash, shared by every stage below)
+    with timer.stage("decode"):
+        y, sr, y_model, file_hash = load_audio_hashed(file_path)
+        duration_orig = float(len(y) / sr)
+        if y_model is y:
+            y_model = y.copy() # The model gets the un-normalized signal
+        # Normalize in place; max|y| without an abs() copy of the signal
+        peak = max(abs(float(y.max(initial=0))), abs(float(y.min(initial=0))))
+        np.divide(y, peak + 1e-9, out=y)
+
+    with timer.stage("envelope"):
+        waveform = generate_waveform_data(y, sr)
 
     # 2. Adaptive Threshold & Split
-    hop_length = 512
-    rms = librosa.feature.rms(y=y_norm, hop_length=hop_length)[0]
-    
-    # Check if rms is empty or all zeros
-    if len(rms) == 0 or np.max(rms) == 0:
-        return {
-            "total_duration": duration_orig,
-            "active_duration": 0.0,
-            "efficiency": 0.0,
-            "keystrokes": 0,
-            "intervals": [],
-            "waveform": generate_waveform_data(y_norm, sr),
-            "midi_filename": None
-        }
+    with timer.stage("gating"):
+        rms = frame_rms(y)
+        del y # Only the model-rate buffer is needed from here on
+
+        # Check if rms is empty or all zeros
+        if len(rms) == 0 or np.max(rms) == 0:
+            spans = None
+        else:
+            rms_db = librosa.amplitude_to_db(rms, ref=np.max)
+            # 3. Only transcribe where there is sound
+            spans = find_active_spans(rms_db, RMS_HOP_LENGTH / sr)
+
+    if spans is None:
+        return _build_result(file_path, file_hash, output_midi_dir, duration_orig, waveform, None,
+                             posteriors=[], cache_dir=cache_dir, timer=timer)
+
+    # 4. Transcription (note events stay in memory; MIDI is only a side output)
+    posteriors = []
+    try:
+        with timer.stage("transcription"):
+            notes = transcribe_spans(y_model, spans, posteriors=posteriors,
+                                     progress=lambda fraction: report_progress(file_path, "transcribing", fraction))
+    except Exception as e:
+        print(f"MIDI generation/analysis failed: {e}")
+        notes = None # Fallback to 0
+        posteriors = None # Nothing worth caching
+
+    return _build_result(file_path, file_hash, output_midi_dir, duration_orig, waveform, notes,
+                         posteriors=posteriors, cache_dir=cache_dir, timer=timer)
+
+def analyze_audio_streaming(file_path, output_midi_dir, cache_dir=None, timer=None):
+    """
+    Same analysis as analyze_audio, but reads the file in blocks so peak
+    memory stays flat regardless of recording length (see StreamingAnalysis).
+    Decoding, envelope and transcription are interleaved; "decode" covers
+    reading, hashing and resampling, "transcription" the model runs.
+    """
+    import soundfile as sf
+
+    timer = timer or StageTimer()
+    info = sf.info(file_path)
+    stream = StreamingAnalysis(info.samplerate, timer=timer, spool_dir=cache_dir)
+    blocksize = stream.hop_length * WAVEFORM_RATE * STREAM_BLOCK_SECONDS
+
+    # Decoding and transcription are interleaved, so progress is reported as transcription
+    report_progress(file_path, "transcribing", 0.0)
+    frames_fed = 0
+    try:
+        with timer.stage("decode"), HashingReader(file_path) as reader:
+            for block in sf.blocks(reader, blocksize=blocksize, dtype='float32', always_2d=True):
+                stream.feed(block[:, 0] if block.shape[1] == 1 else block.mean(axis=1))
+                frames_fed += len(block)
+                report_progress(file_path, "transcribing", frames_fed / max(info.frames, 1))
+            file_hash = reader.hexdigest()
+            envelope, notes = stream.finish()
+    except Exception as e:
+        print(f"Streaming analysis failed: {e}")
+        return None
+
+    waveform = encode_waveform(envelope / (stream.peak + 1e-9))
+    if stream.peak == 0:
+        notes = None # All silence
+    try:
+        return _build_result(file_path, file_hash, output_midi_dir, stream.duration, waveform, notes,
+                             posteriors=stream.posteriors, cache_dir=cache_dir, timer=timer)
+    finally:
+        if stream.posteriors is not None:
+            stream.posteriors.close()
+
+def follow_recording(file_path, output_midi_dir, cache_dir=None):
+    """
+    Analyzes a WAV file while it is still being recorded. Samples are fed to a
+    StreamingAnalysis as they are written, and every LIVE_UPDATE_SECONDS the
+    metrics and waveform so far are sent as a "provisional" event (see
+    report_event). Notes trail the recording by one transcription chunk plus
+    its context (STREAM_CHUNK_SECONDS + STREAM_CONTEXT_SECONDS).
+
+    Once the file hasn't grown for LIVE_IDLE_SECONDS, the analysis is finished
+    as in analyze_audio_streaming and the same result is returned. Returns None
+    if the finished file's header doesn't match what was read (e.g. trailing
+    chunks were taken for samples); the caller should then analyze it normally.
+    """
+    name = os.path.basename(file_path)
+    timer = StageTimer()
+
+    # A recorder may not have written the header yet
+    waited = time.monotonic()
+    while True:
+        try:
+            wav = GrowingWav(file_path)
+            break
+        except EOFError:
+            if time.monotonic() - waited >= LIVE_IDLE_SECONDS:
+                raise
+            time.sleep(LIVE_POLL_SECONDS)
+
+    with wav:
+        stream = StreamingAnalysis(wav.sr, timer=timer, spool_dir=cache_dir)
+        block_frames = stream.hop_length * WAVEFORM_RATE * STREAM_BLOCK_SECONDS
+        last_growth = last_update = time.monotonic()
+        while True:
+            with timer.stage("decode"):
+                block = wav.read(block_frames)
+                stream.feed(block)
+            now = time.monotonic()
+            if len(block):
+                last_growth = now
+            elif now - last_growth >= LIVE_IDLE_SECONDS:
+                break
+
+            if now - last_update >= LIVE_UPDATE_SECONDS:
+                envelope, notes = stream.snapshot()
+                report_event("provisional", file=name, total_duration=stream.duration,
+                             waveform=encode_waveform(envelope / (stream.peak + 1e-9)),
+                             **calculate_metrics_from_notes(notes, stream.duration))
+                last_update = now
+            if len(block) < block_frames:
+                time.sleep(LIVE_POLL_SECONDS) # Caught up with the recorder
+
+        frames = wav.data_frames()
+        if frames is not None and frames != wav.frames_read:
+            print(f"{name}: finished file has {frames} frames, {wav.frames_read} were read while recording")
+            return None
+
+    try:
+        with timer.stage("decode"):
+            envelope, notes = stream.finish()
+            # The header is rewritten when recording stops, so hash the finished file
+            file_hash = get_file_hash(file_path)
+    except Exception as e:
+        print(f"Live analysis failed: {e}")
+        return None
+
+    waveform = encode_waveform(envelope / (stream.peak + 1e-9))
+    if stream.peak == 0:
+        notes = None # All silence
+    try:
+        return _build_result(file_path, file_hash, output_midi_dir, stream.duration, waveform, notes,
+                             posteriors=stream.posteriors, cache_dir=cache_dir, timer=timer)
+    finally:
+        if stream.posteriors is not None:
+            stream.posteriors.close()
+
+class GrowingWav:
+    """
+    Reads the samples of a PCM or float WAV file that is still being written.
+    Recorders fill in the data chunk's size only when they stop, so until then
+    everything after the data chunk header is read as samples, in whole frames,
+    as it is written. Raises EOFError if the header isn't complete yet.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.frames_read = 0
+        self._file = open(file_path, "rb")
+        try:
+            self._parse_header(self._file.read(WAV_HEADER_READ))
+        except Exception:
+            self._file.close()
+            raise
+
+    def _parse_header(self, header):
+        if len(header) < 12:
+            raise EOFError("WAV header not written yet")
+        if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError("Not a RIFF/WAVE file")
+
+        fmt = None
+        pos = 12
+        while pos + 8 <= len(header):
+            chunk_id = header[pos:pos + 4]
+            size, = struct.unpack_from("<I", header, pos + 4)
+            if chunk_id == b"fmt ":
+                if pos + 24 > len(header):
+                    break
+                fmt = struct.unpack_from("<HHIIHH", header, pos + 8)
+                if fmt[0] == 0xFFFE and pos + 34 <= len(header): # WAVE_FORMAT_EXTENSIBLE: sub-format GUID starts with the tag
+                    fmt = (struct.unpack_from("<H", header, pos + 32)[0],) + fmt[1:]
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError("WAV data chunk before fmt chunk")
+                self.data_offset = pos + 8
+                break
+            pos += 8 + size + (size & 1)
+        else:
+            raise EOFError("WAV header not written yet")
+        if fmt is None:
+            raise EOFError("WAV header not written yet")
+
+        self.format_tag, self.channels, self.sr, _, self.block_align, self.bits = fmt
+        if (self.format_tag, self.bits) not in {(1, 8), (1, 16), (1, 24), (1, 32), (3, 32), (3, 64)}:
+            raise ValueError(f"Unsupported WAV sample format (tag {self.format_tag}, {self.bits} bit)")
+        if self.channels == 0 or self.block_align != self.channels * self.bits // 8:
+            raise ValueError("Inconsistent WAV fmt chunk")
+
+    def data_frames(self):
+        """Frame count from the data chunk header, or None while it is still a placeholder."""
+        self._file.seek(self.data_offset - 4)
+        size, = struct.unpack("<I", self._file.read(4))
+        if size == 0 or size >= 0xFFFFFFFF - self.block_align:
+            return None
+        return size // self.block_align
+
+    def read(self, max_frames):
+        """Up to max_frames of the frames written since the last call, as mono float32."""
+        available = (os.fstat(self._file.fileno()).st_size - self.data_offset) // self.block_align
+        frames = self.data_frames()
+        if frames is not None:
+            available = min(available, frames)
+        n = min(max_frames, available - self.frames_read)
+        if n <= 0:
+            return np.zeros(0, dtype=np.float32)
+
+        self._file.seek(self.data_offset + self.frames_read * self.block_align)
+        raw = self._file.read(n * self.block_align)
+        n = len(raw) // self.block_align
+        self.frames_read += n
+        samples = self._decode(raw[:n * self.block_align]).reshape(n, self.channels)
+        return samples[:, 0] if self.channels == 1 else samples.mean(axis=1)
+
+    def _decode(self, raw):
+        # Same scaling as libsndfile's float reads
+        if self.format_tag == 3:
+            return np.frombuffer(raw, dtype="<f4" if self.bits == 32 else "<f8").astype(np.float32, copy=False)
+        if self.bits == 8:
+            return (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+        if self.bits == 16:
+            return np.frombuffer(raw, dtype="<i2").astype(np.float32) / 32768
+        if self.bits == 24:
+            b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            value = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+            return ((value ^ 0x800000) - 0x800000).astype(np.float32) / 8388608
+        return np.frombuffer(raw, dtype="<i4").astype(np.float32) / 2147483648
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def wav_duration(file_path):
+    """Duration in seconds from a WAV file's header (without reading the samples), or None if unknown."""
+    try:
+        with GrowingWav(file_path) as wav:
+            frames = wav.data_frames()
+            return frames / wav.sr if frames is not None and wav.sr else None
+    except (OSError, EOFError, ValueError, struct.error):
+        return None
+
+def _build_result(file_path, file_hash, output_midi_dir, duration_orig, waveform, notes, posteriors=None, cache_dir=None,
+                  timer=None):
+    """
+    Computes metrics from note arrays (None = nothing transcribed) and schedules the MIDI side output.
+    A fresh analysis (`posteriors` not None) is also stored in `cache_dir`.
+    """
+    timer = timer or StageTimer()
+    if cache_dir and posteriors is not None:
+        with timer.stage("cache"):
+            save_cached_analysis(cache_dir, file_path, file_hash, duration_orig, waveform, notes, posteriors)
 
-    rms_db = librosa.amplitude_to_db(rms, ref=np.max)
-    
-    # 4. MIDI Generation (Direct from original file)
     midi_filename = None
     keystrokes = 0
     intervals_sec = []
     active_duration_midi = 0.0
     efficiency_midi = 0.0
-    
-    try:
-        # Pre-calculate output path to clean up old files (force overwrite)
-        base_name = os.path.basename(file_path)
-        name_without_ext = os.path.splitext(base_name)[0]
-        generated_midi_name = name_without_ext + "_basic_pitch.mid"
-        expected_midi_path = os.path.join(output_midi_dir, generated_midi_name)
-        
-        if os.path.exists(expected_midi_path):
-            try:
-                os.remove(expected_midi_path)
-            except Exception as e:
-                print(f"Warning: Could not remove old MIDI {expected_midi_path}: {e}")
-
-        # Predict and save
-        predict_and_save(
-            audio_path_list=[file_path],
-            output_directory=output_midi_dir,
-            save_midi=True,
-            sonify_midi=False,
-            save_model_outputs=False,
-            save_notes=False,
-            model_or_model_path=ICASSP_2022_MODEL_PATH
-        )
-        
-        if os.path.exists(expected_midi_path):
-            midi_filename = generated_midi_name
-            midi_path = expected_midi_path # Use consistency
-            
-            # Use shared calculation logic
-            metrics = calculate_metrics_from_midi(midi_path, duration_orig)
-            if metrics:
-                active_duration_midi = metrics['active_duration']
-                efficiency_midi = metrics['efficiency']
-                keystrokes = metrics['keystrokes']
-                intervals_sec = metrics['intervals']
-                
-    except Exception as e:
-        print(f"MIDI generation/analysis failed: {e}")
-        # Fallback to 0
+
+    if notes is not None:
+        # Use shared calculation logic
+        with timer.stage("metrics"):
+            metrics = calculate_metrics_from_notes(notes, duration_orig)
+        active_duration_midi = metrics['active_duration']
+        efficiency_midi = metrics['efficiency']
+        keystrokes = metrics['keystrokes']
+        intervals_sec = metrics['intervals']
+
+        if output_midi_dir:
+            base_name = os.path.basename(file_path)
+            name_without_ext = os.path.splitext(base_name)[0]
+            midi_filename = name_without_ext + "_basic_pitch.mid"
+            save_midi_async(notes, os.path.join(output_midi_dir, midi_filename))
 
     return {
         "total_duration": duration_orig,
         "active_duration": active_duration_midi,
         "efficiency": efficiency_midi,
         "keystrokes": keystrokes,
-        "intervals": intervals_sec, # List of [start, end] derived from MIDI
-        "waveform": generate_waveform_data(y_norm, sr),
-        "midi_filename": midi_filename
+        "intervals": intervals_sec, # List of [start, end] derived from note events
+        "waveform": waveform,
+        "midi_filename": midi_filename,
+        "hash": file_hash, # Full content hash, computed here so the web process never reads the whole file
+        "timings": timer.stages
+    }
+
+def _cache_path(cache_dir, quick_hash, file_hash):
+    return os.path.join(cache_dir, f"{MODEL_NAME}_v{ANALYZER_VERSION}", f"{quick_hash}_{file_hash}.npz")
+
+def save_cached_analysis(cache_dir, file_path, file_hash, duration, waveform, notes, posteriors):
+    """
+    Stores an analysis as one compressed .npz: duration, waveform blob, notes
+    (absent for silent files), the note extraction settings they were made with,
+    and every transcribed segment's float16 posteriors, concatenated.
+    `posteriors` is a list of packed segments or a PosteriorSpool, whose
+    arrays are copied from disk without being loaded.
+    """
+    try:
+        path = _cache_path(cache_dir, get_quick_hash(file_path), file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        spooled = isinstance(posteriors, PosteriorSpool)
+        segments = posteriors.segments if spooled else [{**seg, "frames": len(seg["note"])} for seg in posteriors]
+        arrays = {
+            "hash": np.array(file_hash),
+            "duration": np.array(duration),
+            "waveform": np.frombuffer(waveform, dtype=np.uint8),
+            "extraction": np.array([ONSET_THRESHOLD, FRAME_THRESHOLD, MINIMUM_NOTE_LENGTH_MS]),
+            "segment_offset": np.array([seg["offset"] for seg in segments], dtype=np.float64),
+            "segment_keep": np.array([seg["keep"] for seg in segments], dtype=np.float64).reshape(-1, 2),
+            "segment_frames": np.array([seg["frames"] for seg in segments], dtype=np.int64),
+        }
+        if not spooled:
+            for k in ("note", "onset"):
+                arrays[k] = np.concatenate([seg[k] for seg in posteriors]) if posteriors else np.zeros((0, 0), dtype=np.float16)
+        if notes is not None:
+            arrays.update({f"notes_{k}": v for k, v in notes.items()})
+
+        # Write then rename, so a concurrent reader never sees a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            _write_npz(f, arrays, posteriors if spooled else None)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Warning: Could not cache analysis of {file_path}: {e}")
+
+def _write_npz(f, arrays, spool=None):
+    """
+    np.savez_compressed, plus the "note" and "onset" arrays of a PosteriorSpool
+    streamed into the archive from its files.
+    """
+    with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, value in arrays.items():
+            with zf.open(f"{name}.npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array(member, np.asanyarray(value), allow_pickle=False)
+        if spool is not None:
+            for name in ("note", "onset"):
+                with zf.open(f"{name}.npy", "w", force_zip64=True) as member:
+                    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float16)),
+                              "fortran_order": False, "shape": spool.shape(name)}
+                    np.lib.format.write_array_header_1_0(member, header)
+                    spool.copy_to(name, member)
+
+def load_cached_analysis(cache_dir, file_path):
+    """
+    Returns the cached analysis of the file's content as a dict (hash, duration,
+    waveform, notes, posteriors), or None. Cache entries are named by quick and
+    full hash, so a file with no entry is rejected without reading it in full.
+    Entries made with other note extraction settings get their notes re-extracted
+    from the stored posteriors.
+    """
+    try:
+        quick_hash = get_quick_hash(file_path)
+        version_dir = os.path.dirname(_cache_path(cache_dir, quick_hash, ""))
+        if not os.path.isdir(version_dir) or not any(n.startswith(quick_hash + "_") for n in os.listdir(version_dir)):
+            return None
+
+        path = _cache_path(cache_dir, quick_hash, get_file_hash(file_path))
+        if not os.path.exists(path):
+            return None
+
+        cached = _read_cache_entry(path)
+        if cached["notes"] is not None and cached["extraction"] != [ONSET_THRESHOLD, FRAME_THRESHOLD, MINIMUM_NOTE_LENGTH_MS]:
+            cached["notes"] = notes_from_posteriors(cached["posteriors"])
+        return cached
+    except Exception as e:
+        print(f"Warning: Could not read cached analysis of {file_path}: {e}")
+        return None
+
+def find_cache_entry(cache_dir, file_hash):
+    """Path of the cache entry for a content hash (e.g. a Session hash), or None."""
+    version_dir = os.path.dirname(_cache_path(cache_dir, "", file_hash))
+    if os.path.isdir(version_dir):
+        for name in os.listdir(version_dir):
+            if name.endswith(f"_{file_hash}.npz"):
+                return os.path.join(version_dir, name)
+    return None
+
+def cached_hashes(cache_dir):
+    """Content hashes with a cache entry for the current analyzer version."""
+    version_dir = os.path.dirname(_cache_path(cache_dir, "", ""))
+    if not os.path.isdir(version_dir):
+        return set()
+    return {name[:-len(".npz")].split("_")[-1] for name in os.listdir(version_dir) if name.endswith(".npz")}
+
+def _read_cache_entry(path):
+    with np.load(path) as data:
+        notes = None
+        if "notes_start" in data:
+            notes = {k: data[f"notes_{k}"] for k in ("start", "end", "pitch", "velocity")}
+
+        # Each item access on an NpzFile decompresses the array again, so read them once
+        note, onset = data["note"], data["onset"]
+        bounds = np.cumsum(np.concatenate([[0], data["segment_frames"]]))
+        posteriors = [
+            {"offset": float(offset), "note": note[a:b], "onset": onset[a:b], "keep": tuple(keep)}
+            for offset, keep, a, b in zip(data["segment_offset"], data["segment_keep"], bounds[:-1], bounds[1:])
+        ]
+        return {
+            "hash": str(data["hash"]),
+            "duration": float(data["duration"]),
+            "waveform": waveform_pyramid(data["waveform"].tobytes()),
+            "extraction": data["extraction"].tolist(),
+            "notes": notes,
+            "posteriors": posteriors,
+        }
+
+def reextract_metrics(cache_dir, file_hash, midi_path=None, **thresholds):
+    """
+    Regenerates notes and metrics for an analyzed recording from its cached
+    posteriors with the given thresholds (see notes_from_model_output), and
+    rewrites its MIDI file. Returns the metrics, or None if it isn't cached.
+    """
+    path = find_cache_entry(cache_dir, file_hash)
+    if path is None:
+        return None
+
+    cached = _read_cache_entry(path)
+    notes = notes_from_posteriors(cached["posteriors"], **thresholds)
+    if midi_path:
+        write_midi(notes, midi_path)
+    return calculate_metrics_from_notes(notes, cached["duration"])
+
+class StreamingAnalysis:
+    """
+    Incremental analysis of a recording fed as consecutive blocks of mono
+    float32 samples at the native rate. Keeps a running peak and the raw
+    (un-normalized) envelope, resamples to the model rate as it goes, and
+    transcribes in STREAM_CHUNK_SECONDS chunks. Each chunk is run with
+    STREAM_CONTEXT_SECONDS of audio on both sides and keeps only the notes
+    whose onset falls inside it, so notes crossing a boundary are neither
+    lost nor counted twice. Chunk and context lengths are rounded to whole
+    model windows so every run sees the same window grid as a single pass
+    over the file would. Silent spans are skipped as in analyze_audio, but
+    relative to the loudest RMS frame seen so far. Memory is bounded by the
+    chunk size. With a `spool_dir` (the analysis cache), each run's posteriors
+    are written to a PosteriorSpool there as they are produced; without one
+    they are not kept at all (self.posteriors is None).
+    """
+
+    def __init__(self, sr, model=None, timer=None, spool_dir=None):
+        self.sr = sr
+        self.model = model
+        self.timer = timer or StageTimer()
+        self.hop_length = max(1, sr // WAVEFORM_RATE)
+        self.n_samples = 0
+        self.peak = 0.0
+
+        self._envelope = []
+        self._envelope_carry = np.zeros(0, dtype=np.float32)
+
+        self._resampler = None
+        if sr != AUDIO_SAMPLE_RATE:
+            import soxr
+            self._resampler = soxr.ResampleStream(sr, AUDIO_SAMPLE_RATE, 1, dtype='float32', quality='HQ')
+        self._chunk = _whole_model_windows(STREAM_CHUNK_SECONDS)
+        self._context = _whole_model_windows(STREAM_CONTEXT_SECONDS)
+        self._model_audio = np.zeros(0, dtype=np.float32)
+        self._model_start = 0 # Model-rate sample index of _model_audio[0]
+        self._chunk_start = 0 # Model-rate sample index where the next chunk begins
+        self._rms_ref = 0.0
+        self._notes = []
+        self.posteriors = PosteriorSpool(spool_dir) if spool_dir else None # For the analysis cache
+
+    @property
+    def duration(self):
+        return float(self.n_samples / self.sr)
+
+    def feed(self, block):
+        """Consumes the next block of mono float32 samples."""
+        if len(block) == 0:
+            return
+        self.n_samples += len(block)
+        self.peak = max(self.peak, float(abs(block.max())), float(abs(block.min())))
+        self._feed_envelope(block)
+
+        if self._resampler is not None:
+            block = self._resampler.resample_chunk(block)
+        self._feed_model(block)
+
+    def snapshot(self):
+        """(raw envelope, note arrays) of what has been processed so far, without flushing pending audio."""
+        envelope = np.concatenate(self._envelope) if self._envelope else np.zeros(0, dtype=np.float32)
+        return envelope, concat_notes(list(self._notes))
+
+    def finish(self):
+        """Flushes all pending audio. Returns (raw envelope, note arrays)."""
+        if self._resampler is not None:
+            self._feed_model(self._resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+        self._transcribe_chunk(final=True)
+
+        if len(self._envelope_carry):
+            self._envelope.append(waveform_envelope(self._envelope_carry, self.hop_length))
+            self._envelope_carry = np.zeros(0, dtype=np.float32)
+
+        envelope = np.concatenate(self._envelope) if self._envelope else np.zeros(0, dtype=np.float32)
+        return envelope, concat_notes(self._notes)
+
+    def _feed_envelope(self, block):
+        if len(self._envelope_carry):
+            block = np.concatenate([self._envelope_carry, block])
+        n_full = len(block) // self.hop_length * self.hop_length
+        if n_full:
+            self._envelope.append(waveform_envelope(block[:n_full], self.hop_length))
+        self._envelope_carry = block[n_full:].copy()
+
+    def _feed_model(self, samples):
+        self._model_audio = np.concatenate([self._model_audio, samples])
+        while self._model_start + len(self._model_audio) >= self._chunk_start + self._chunk + self._context:
+            self._transcribe_chunk()
+
+    def _transcribe_chunk(self, final=False):
+        with self.timer.stage("transcription"):
+            self._run_chunk(final)
+
+    def _run_chunk(self, final):
+        import librosa
+
+        chunk, context = self._chunk, self._context
+        available_end = self._model_start + len(self._model_audio)
+
+        run_start = max(self._model_start, self._chunk_start - context)
+        chunk_end = available_end if final else self._chunk_start + chunk
+        run_end = available_end if final else chunk_end + context
+        if run_end <= run_start:
+            return
+
+        segment = self._model_audio[run_start - self._model_start:run_end - self._model_start]
+
+        # Silence gating against the loudest RMS frame seen so far
+        rms = frame_rms(segment)
+        self._rms_ref = max(self._rms_ref, float(rms.max()) if len(rms) else 0.0)
+        if self._rms_ref == 0:
+            spans = []
+        else:
+            rms_db = librosa.amplitude_to_db(rms, ref=self._rms_ref)
+            spans = find_active_spans(rms_db, RMS_HOP_LENGTH / AUDIO_SAMPLE_RATE)
+        posteriors = [] if self.posteriors is not None else None
+        notes = transcribe_spans(segment, spans, self.model, offset=run_start / AUDIO_SAMPLE_RATE, posteriors=posteriors)
+
+        # Keep notes whose onset is inside this chunk; the context belongs to the neighbours
+        keep_start = self._chunk_start / AUDIO_SAMPLE_RATE if self._chunk_start > 0 else -np.inf
+        keep_end = np.inf if final else chunk_end / AUDIO_SAMPLE_RATE
+        keep = (notes["start"] >= keep_start) & (notes["start"] < keep_end)
+        self._notes.append({k: v[keep] for k, v in notes.items()})
+        for seg in posteriors or []:
+            seg["keep"] = (keep_start, keep_end)
+            self.posteriors.append(seg)
+
+        if not final:
+            # Drop audio no longer needed as context for the next chunk
+            new_start = chunk_end - context
+            self._model_audio = self._model_audio[new_start - self._model_start:].copy()
+            self._model_start = new_start
+            self._chunk_start = chunk_end
+
+class PosteriorSpool:
+    """
+    Append-only sink for packed posteriors (see pack_posteriors) that writes
+    the float16 note and onset arrays to temporary files in `dir` instead of
+    keeping them in memory; only each segment's offset, keep range and frame
+    count stay in `segments`. save_cached_analysis copies the files into the
+    cache entry. The files are deleted when the spool is closed or collected.
+    """
+
+    def __init__(self, dir=None):
+        if dir:
+            os.makedirs(dir, exist_ok=True)
+        self.segments = []
+        self.columns = {}
+        self._files = {k: tempfile.TemporaryFile(dir=dir) for k in ("note", "onset")}
+
+    def append(self, seg):
+        for k, f in self._files.items():
+            f.write(np.ascontiguousarray(seg[k], dtype=np.float16).tobytes())
+            self.columns[k] = seg[k].shape[1]
+        self.segments.append({"offset": seg["offset"], "keep": seg["keep"], "frames": len(seg["note"])})
+
+    def __len__(self):
+        return len(self.segments)
+
+    def shape(self, key):
+        """Shape of the concatenated `key` ("note" / "onset") array."""
+        if not self.segments:
+            return (0, 0)
+        return (sum(seg["frames"] for seg in self.segments), self.columns[key])
+
+    def copy_to(self, key, out):
+        """Writes the raw float16 bytes of `key`, in segment order, to file object `out`."""
+        f = self._files[key]
+        f.flush()
+        f.seek(0)
+        shutil.copyfileobj(f, out, 1 << 20)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+def _whole_model_windows(seconds):
+    """`seconds` of model-rate audio, rounded to a whole number of model windows (at least one)."""
+    return max(1, round(seconds * AUDIO_SAMPLE_RATE / MODEL_HOP_SAMPLES)) * MODEL_HOP_SAMPLES
+
+def concat_notes(parts):
+    """Concatenates a list of note arrays dicts (see notes_from_model_output)."""
+    if not parts:
+        return empty_notes()
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+def empty_notes():
+    return {
+        "start": np.zeros(0, dtype=np.float64),
+        "end": np.zeros(0, dtype=np.float64),
+        "pitch": np.zeros(0, dtype=np.int16),
+        "velocity": np.zeros(0, dtype=np.int16),
+    }
+
+def notes_from_midi(midi_path):
+    """
+    Reads note events back from a MIDI file (for sessions analyzed before notes
+    were kept in memory), paired the way metrics were always computed from MIDI:
+    note_ons below MIN_VELOCITY are ignored, and a note re-struck before its
+    note_off restarts there. The earlier strike is kept as a zero-length note,
+    so it still counts as a keystroke but adds no active time.
+    """
+    mid = mido.MidiFile(midi_path)
+
+    start, end, pitch, velocity = [], [], [], []
+    active_notes = {} # note -> (start_time, velocity)
+    current_time = 0.0
+
+    # mido.MidiFile is iterable and yields messages in playback order (delta times applied)
+    for msg in mid:
+        current_time += msg.time
+
+        if msg.type == 'note_on' and msg.velocity >= MIN_VELOCITY:
+            if msg.note in active_notes:
+                start_t, vel = active_notes[msg.note]
+                start.append(start_t); end.append(start_t); pitch.append(msg.note); velocity.append(vel)
+            active_notes[msg.note] = (current_time, msg.velocity)
+
+        elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
+            if msg.note in active_notes:
+                start_t, vel = active_notes.pop(msg.note)
+                start.append(start_t); end.append(current_time); pitch.append(msg.note); velocity.append(vel)
+
+    # Close any lingering notes
+    for note, (start_t, vel) in active_notes.items():
+        start.append(start_t); end.append(current_time); pitch.append(note); velocity.append(vel)
+
+    return {
+        "start": np.asarray(start, dtype=np.float64),
+        "end": np.asarray(end, dtype=np.float64),
+        "pitch": np.asarray(pitch, dtype=np.int16),
+        "velocity": np.asarray(velocity, dtype=np.int16),
     }
 
+def write_midi(notes, midi_path):
+    """Serializes note arrays to a MIDI file (overwrites any existing file)."""
+    from basic_pitch.note_creation import note_events_to_midi
+
+    note_events = [
+        (float(s), float(e), int(p), float(v) / 127, None)
+        for s, e, p, v in zip(notes["start"], notes["end"], notes["pitch"], notes["velocity"])
+    ]
+    midi_data = note_events_to_midi(note_events)
+    if os.path.exists(midi_path):
+        os.remove(midi_path)
+    midi_data.write(midi_path)
+
+def save_midi_async(notes, midi_path):
+    """Writes the MIDI side output on a background thread, off the analysis critical path."""
+    def _write():
+        try:
+            write_midi(notes, midi_path)
+        except Exception as e:
+            print(f"Warning: Could not write MIDI {midi_path}: {e}")
+
+    thread = threading.Thread(target=_write, daemon=True)
+    thread.start()
+    return thread
+
 def calculate_metrics_from_midi(midi_path, duration_orig):
     """
     Recalculates metrics (active duration, efficiency, keystrokes) 
     from a MIDI file using current thresholds.
     """
     try:
-        mid = mido.MidiFile(midi_path)
-        
-        # User defined threshold for "valid" practice
-        MIN_VELOCITY = 70
-        
-        # 1. Extract valid note intervals
-        valid_raw_intervals = []
-        active_notes = {} # note -> start_time
-        
-        current_time = 0.0
-        keystrokes = 0
-        
-        # mido.MidiFile is iterable and yields messages in playback order (delta times applied)
-        for msg in mid:
-            current_time += msg.time
-            
-            if msg.type == 'note_on' and msg.velocity >= MIN_VELOCITY:
-                # Valid key press
-                keystrokes += 1
-                active_notes[msg.note] = current_time
-                
-            elif (msg.type == 'note_off') or (msg.type == 'note_on' and msg.velocity == 0):
-                # Note ending
-                if msg.note in active_notes:
-                    start_t = active_notes.pop(msg.note)
-                    end_t = current_time
-                    if end_t > start_t: 
-                        valid_raw_intervals.append((start_t, end_t))
-        
-        # Close any lingering notes
-        for note, start_t in active_notes.items():
-            if current_time > start_t:
-                valid_raw_intervals.append((start_t, current_time))
-        
-        # 2. Merge Intervals
-        intervals_sec = []
-        active_duration_midi = 0.0
-        efficiency_midi = 0.0
-        
-        if valid_raw_intervals:
-            valid_raw_intervals.sort(key=lambda x: x[0])
-            merged = []
-            
-            gap_threshold = 2.0
-            
-            # Initial
-            curr_start, curr_end = valid_raw_intervals[0]
-            
-            for i in range(1, len(valid_raw_intervals)):
-                next_start, next_end = valid_raw_intervals[i]
-                
-                if next_start - curr_end <= gap_threshold:
-                    # Close enough, merge
-                    curr_end = max(curr_end, next_end)
-                else:
-                    # Seal
-                    start_padded = max(0, curr_start - 0.5)
-                    end_padded = min(duration_orig, curr_end + 0.5)
-                    merged.append([start_padded, end_padded])
-                    
-                    curr_start = next_start
-                    curr_end = next_end
-            
-            # Last
-            start_padded = max(0, curr_start - 0.5)
-            end_padded = min(duration_orig, curr_end + 0.5)
-            merged.append([start_padded, end_padded])
-            
-            intervals_sec = merged
-            active_duration_midi = sum(end - start for start, end in merged)
-            efficiency_midi = (active_duration_midi / duration_orig) if duration_orig > 0 else 0
-            
-        return {
-            "active_duration": active_duration_midi,
-            "efficiency": efficiency_midi,
-            "keystrokes": keystrokes,
-            "intervals": intervals_sec
-        }
+        return calculate_metrics_from_notes(notes_from_midi(midi_path), duration_orig)
     except Exception as e:
         print(f"Error recalculating metrics from MIDI: {e}")
         return None
+
+def calculate_metrics_from_notes(notes, duration_orig):
+    """
+    Calculates metrics (active duration, efficiency, keystrokes) from
+    note arrays (see notes_from_model_output) using current thresholds.
+    """
+    # 1. Extract valid note intervals
+    valid = notes["velocity"] >= MIN_VELOCITY
+    keystrokes = int(np.count_nonzero(valid))
+
+    starts = notes["start"][valid]
+    ends = notes["end"][valid]
+    sounding = ends > starts
+    starts, ends = starts[sounding], ends[sounding]
+    
+    # 2. Merge Intervals
+    intervals_sec = []
+    active_duration_midi = 0.0
+    efficiency_midi = 0.0
+    
+    if len(starts):
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+
+        # Running max of note ends = end of the interval being built at each note.
+        # A new interval starts wherever the gap to it exceeds the threshold.
+        reach = np.maximum.accumulate(ends)
+        seal = starts[1:] - reach[:-1] > GAP_THRESHOLD
+        first = np.concatenate([[0], np.flatnonzero(seal) + 1])
+        last = np.concatenate([first[1:] - 1, [len(starts) - 1]])
+
+        # Pad each merged interval, clamped to the recording
+        merged = [
+            [max(0, curr_start - INTERVAL_PADDING), min(duration_orig, curr_end + INTERVAL_PADDING)]
+            for curr_start, curr_end in zip(starts[first].tolist(), reach[last].tolist())
+        ]
+        
+        intervals_sec = merged
+        active_duration_midi = sum(end - start for start, end in merged)
+        efficiency_midi = (active_duration_midi / duration_orig) if duration_orig > 0 else 0
+        
+    return {
+        "active_duration": active_duration_midi,
+        "efficiency": efficiency_midi,
+        "keystrokes": keystrokes,
+        "intervals": intervals_sec
+    }
@@ -1,11 +1,15 @@
 import os
 import time
+import hashlib
 import threading
 import json
+import math
+import struct
 from datetime import datetime, timedelta
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response
 from flask_sqlalchemy import SQLAlchemy
-from analyzer import get_file_hash, analyze_audio, calculate_metrics_from_midi
+from sqlalchemy.orm import deferred
+from analyzer import get_file_hash, get_quick_hash, calculate_metrics_from_midi, encode_waveform, encode_waveform_level, select_waveform_level, waveform_pyramid
 
 app = Flask(__name__)
 # Configure DB
@@ -19,6 +23,7 @@ db = SQLAlchemy(app)
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 MIDI_FOLDER = os.path.join(BASE_DIR, 'static', 'midi')
 INSTANCE_FOLDER = os.path.join(BASE_DIR, 'instance')
+CACHE_FOLDER = os.path.join(INSTANCE_FOLDER, 'cache') # Analysis cache (see analyzer.load_cached_analysis)
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(MIDI_FOLDER, exist_ok=True)
@@ -34,9 +39,16 @@ class Session(db.Model):
     active_duration = db.Column(db.Float)
     keystrokes = db.Column(db.Integer)
     efficiency = db.Column(db.Float)
-    waveform_json = db.Column(db.Text)
+    # Waveforms are only loaded by the waveform endpoint, not by list queries
+    waveform_json = deferred(db.Column(db.Text)) # Legacy JSON envelope, converted to waveform_blob on first read
+    waveform_blob = deferred(db.Column(db.LargeBinary)) # Envelope pyramid, see analyzer.encode_waveform
     intervals_json = db.Column(db.Text)
     midi_url = db.Column(db.String(256))
+    # Cheap fingerprint for duplicate pre-checks (see analyzer.get_quick_hash)
+    file_size = db.Column(db.Integer)
+    quick_hash = db.Column(db.String(64))
+    # Recording still being written: metrics so far, replaced by the real session when it finishes
+    provisional = db.Column(db.Boolean, default=False)
 
     def to_dict(self):
         return {
@@ -47,136 +59,691 @@ class Session(db.Model):
             'active_duration': self.active_duration,
             'keystrokes': self.keystrokes,
             'efficiency': self.efficiency,
-            'waveform': json.loads(self.waveform_json) if self.waveform_json else [],
+            'waveform_url': f'/api/session/{self.hash}/waveform',
             'intervals': json.loads(self.intervals_json) if self.intervals_json else [],
-            'midi_url': self.midi_url
+            'midi_url': self.midi_url,
+            'provisional': bool(self.provisional)
         }
 
+class SessionTiming(db.Model):
+    """Wall and CPU seconds spent on one stage of analyzing and saving a session (see analyzer.StageTimer)."""
+    __tablename__ = 'session_timings'
+    id = db.Column(db.Integer, primary_key=True)
+    session_hash = db.Column(db.String(64), db.ForeignKey('sessions.hash'), index=True)
+    stage = db.Column(db.String(32))
+    wall = db.Column(db.Float)
+    cpu = db.Column(db.Float)
+
+class Job(db.Model):
+    """
+    Durable state of analyzing one file in uploads/ (see process_uploads):
+    pending -> running -> done, or back to pending with a backoff after a
+    failure, and failed after JOB_MAX_ATTEMPTS. The file's size and mtime
+    identify its version, so a replaced file starts over.
+    """
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(256), index=True)
+    file_size = db.Column(db.Integer)
+    file_mtime = db.Column(db.Float)
+    state = db.Column(db.String(16), index=True, default='pending') # pending / running / done / failed
+    priority = db.Column(db.Integer, default=0) # Higher goes first regardless of JOB_ORDER (1 = pinned from /admin)
+    recorded_at = db.Column(db.DateTime) # Estimated recording start, for JOB_ORDER 'newest'
+    duration = db.Column(db.Float) # Seconds, from the WAV header (None if unknown), for JOB_ORDER 'shortest'
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    session_hash = db.Column(db.String(64)) # Session the job produced (or duplicated)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime) # Of the latest attempt
+    finished_at = db.Column(db.DateTime)
+    next_attempt_at = db.Column(db.DateTime) # Earliest retry after a failed attempt
+
+    def to_dict(self):
+        def iso(dt):
+            return dt.isoformat() if dt else None
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'state': self.state,
+            'priority': self.priority or 0,
+            'recorded_at': iso(self.recorded_at),
+            'duration': self.duration,
+            'attempts': self.attempts,
+            'last_error': self.last_error,
+            'session_hash': self.session_hash,
+            'created_at': iso(self.created_at),
+            'started_at': iso(self.started_at),
+            'finished_at': iso(self.finished_at),
+            'next_attempt_at': iso(self.next_attempt_at),
+        }
+
+def upgrade_schema():
+    """Adds columns introduced after a table was first created (create_all never alters tables)."""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                print(f"Schema upgrade: adding {table.name}.{column.name}")
+                db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    db.session.commit()
+
 import shutil
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import analyzer
+from watcher import UploadWatcher, StabilityTracker
+
+# Number of analysis processes. Each one keeps its own warm transcription model,
+# so memory grows with this; throughput scales with it up to the number of cores.
+ANALYSIS_WORKERS = max(1, int(os.environ.get('SONATA_ANALYSIS_WORKERS', '1')))
+
+def create_analysis_pool(events):
+    # spawn (not fork): the parent may already hold TensorFlow state that must not be copied
+    return ProcessPoolExecutor(
+        max_workers=ANALYSIS_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=analyzer.init_worker,
+        initargs=(events,),
+    )
+
+# Recordings still being written are followed by analyzer.follow_recording in their
+# own single-process pool (one live recording at a time; more queue up), so a long
+# practice session doesn't hold up uploads. Provisional results come back on an
+# event queue. Set SONATA_LIVE_ANALYSIS=0 to wait for files to finish instead.
+LIVE_ANALYSIS = os.environ.get('SONATA_LIVE_ANALYSIS', '1') != '0'
+
+# Uploads are analyzed once their size and mtime haven't changed for this many seconds
+STABLE_SECONDS = float(os.environ.get('SONATA_STABLE_SECONDS', '2'))
+
+# A failed analysis is retried after JOB_RETRY_SECONDS, doubling each time, until its
+# job has had JOB_MAX_ATTEMPTS attempts. It is then marked failed and its file left
+# in uploads/ until it is retried from /admin or the file changes.
+JOB_MAX_ATTEMPTS = max(1, int(os.environ.get('SONATA_JOB_MAX_ATTEMPTS', '3')))
+JOB_RETRY_SECONDS = 30
+
+# Order in which pending jobs are analyzed: 'newest' recording first (so today's takes
+# show up during a large backfill), 'shortest' first, or 'fifo' (order of arrival).
+# Jobs pinned from /admin always go first.
+JOB_ORDER = os.environ.get('SONATA_JOB_ORDER', 'newest')
+if JOB_ORDER not in ('newest', 'shortest', 'fifo'):
+    raise ValueError(f"SONATA_JOB_ORDER must be newest, shortest or fifo, not {JOB_ORDER!r}")
+
+# The worker's upload watcher, so admin actions can wake it up
+_upload_watcher = None
+
+def create_live_pool(events):
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=analyzer.init_worker,
+        initargs=(events,),
+    )
+
+# Ingestion progress for the dashboard (/api/events, server-sent events): the worker
+# thread and the analysis processes publish, every connected browser gets a copy.
+# Events: queued, decoding / transcribing (with percent), provisional, discarded, saved, failed.
+_subscribers = []
+_subscribers_lock = threading.Lock()
+_in_progress = {} # filename -> its latest queued/decoding/transcribing event, replayed to new subscribers
+PROGRESS_EVENTS = ('queued', 'decoding', 'transcribing')
+EVENT_QUEUE_SIZE = 1000 # Per subscriber; a client that falls this far behind misses events
+EVENT_KEEPALIVE_SECONDS = 15
+
+def publish(event, _if_in_progress=False, **fields):
+    """
+    Sends an event to every /api/events subscriber. With _if_in_progress, only
+    if the file hasn't been saved or failed since (progress from a pool process
+    can arrive after its result).
+    """
+    message = {"event": event, **fields}
+    with _subscribers_lock:
+        if _if_in_progress and fields.get('file') not in _in_progress:
+            return
+        if event in PROGRESS_EVENTS:
+            _in_progress[fields['file']] = message
+        else:
+            _in_progress.pop(fields.get('file'), None)
+        for q in _subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass
+
+def relay_events(events, updates):
+    """
+    Forwards messages from analysis processes (see analyzer.report_event) as they
+    arrive: progress straight to subscribers, provisional results to `updates`
+    for the worker thread to save.
+    """
+    while True:
+        try:
+            event = events.get()
+        except Exception as e:
+            print(f"Event relay stopped: {e}")
+            return
+        if event['event'] == 'provisional':
+            updates.put(event)
+        else:
+            publish(event.pop('event'), _if_in_progress=True, **event)
+
+# Re-extracting notes from cached posteriors needs basic_pitch (and so TensorFlow,
+# on the tf backend) too; it runs in its own single-process pool so it doesn't queue behind uploads.
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def get_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        return _extraction_pool
 
 # Background Worker
 def process_uploads():
-    """Background thread to process files in uploads/"""
-    print("Background worker started...")
+    """
+    Background thread to process files in uploads/.
+    Each scan records stable files as Jobs, which are claimed into the process
+    pool as analysis processes free up. This thread only schedules files and
+    does the DB writes and archiving, so those stay serialized.
+    """
+    global _upload_watcher
+    print(f"Background worker started ({ANALYSIS_WORKERS} analysis processes, {analyzer.MODEL_BACKEND} backend)...")
+    events = multiprocessing.get_context('spawn').Queue()
+    updates = queue.Queue() # Provisional results of live recordings, saved by this thread
+    threading.Thread(target=relay_events, args=(events, updates), daemon=True).start()
+    pool = create_analysis_pool(events)
+    # future -> (filename, (file_size, quick_hash), StageTimer, job id); fingerprint and job id are None for live recordings
+    in_flight = {}
+    backfilled = False
+    live_pool = None
+    unfollowable = set() # Growing files live analysis failed on; these wait until they stop changing
+    watcher = _upload_watcher = UploadWatcher(UPLOAD_FOLDER)
+    stability = StabilityTracker(STABLE_SECONDS, recording=is_recording)
+
     while True:
         try:
-            files = [f for f in os.listdir(UPLOAD_FOLDER) if f.lower().endswith('.wav')]
+            if not backfilled:
+                backfill_fingerprints()
+                recover_jobs()
+                backfilled = True
+
+            watcher.clear()
+            busy = {entry[0] for entry in in_flight.values()}
+            files = [f for f in os.listdir(UPLOAD_FOLDER) if f.lower().endswith('.wav') and f not in busy]
+            unfollowable &= set(files)
+            stability.prune(files)
+            ready = {}
             for f in files:
                 file_path = os.path.join(UPLOAD_FOLDER, f)
                 
-                # Check if file is fully written (simple check: size stable?)
-                # Or just try to process.
-                
-                print(f"Processing {f}...")
-                
-                # Check for file stability (avoid processing partial copies)
+                # Check for file stability (avoid processing partial copies), from
+                # what earlier scans saw rather than by waiting here
                 try:
-                    init_size = os.path.getsize(file_path)
-                    time.sleep(1) # Wait a bit
-                    final_size = os.path.getsize(file_path)
-                    if init_size != final_size:
-                        print(f"File {f} is changing (copying?), skipping for now.")
+                    status = stability.check(f, file_path)
+                    if status == StabilityTracker.PENDING:
+                        continue
+                    if status == StabilityTracker.GROWING:
+                        if LIVE_ANALYSIS and f not in unfollowable:
+                            print(f"File {f} is still being written, analyzing it live.")
+                            if live_pool is None:
+                                live_pool = create_live_pool(events)
+                            future = live_pool.submit(analyzer.follow_recording, file_path, MIDI_FOLDER, cache_dir=CACHE_FOLDER)
+                            in_flight[future] = (f, None, analyzer.StageTimer(cpu_clock=time.thread_time), None)
+                            continue
+                        print(f"File {f} is still being recorded, skipping for now.")
                         continue
+                    st = os.stat(file_path)
                     # Also check for zero size
-                    if final_size == 0:
+                    if st.st_size == 0:
                          print(f"File {f} is empty, skipping.")
                          continue
+                    ready[f] = st
                 except Exception as e:
                     print(f"Error checking file stability {f}: {e}")
                     continue
+            sync_jobs(ready)
 
-                # 1. Hashing
-                file_hash = get_file_hash(file_path)
-                
-                # Check DB
-                with app.app_context():
-                    existing = db.session.get(Session, file_hash)
-                    if existing:
-                        print(f"Duplicate file {f} (Hash: {file_hash}). Skipping.")
-                        os.remove(file_path)
-                        continue
-                
-                # 2. Analyze
-                with app.app_context():
-                    # We run analyze inside app context just in case, though analyzer is independent.
-                    # analyze_audio returns a dict
-                    result = analyze_audio(file_path, MIDI_FOLDER)
-                
+            # Claim due jobs while analysis processes are free
+            free = ANALYSIS_WORKERS - sum(1 for entry in in_flight.values() if entry[3] is not None)
+            claimed = set()
+            while free > 0:
+                job = next_job(busy | claimed)
+                if job is None:
+                    break
+                job_id, f = job
+                claimed.add(f)
+                file_path = os.path.join(UPLOAD_FOLDER, f)
+                print(f"Processing {f}...")
+
+                # 1. Duplicate check: size + head/tail fingerprint first, full hash only on a match
+                # (timed on this thread's CPU clock; the web server shares the process)
+                timer = analyzer.StageTimer(cpu_clock=time.thread_time)
+                try:
+                    with timer.stage('fingerprint'):
+                        fingerprint = (os.path.getsize(file_path), get_quick_hash(file_path))
+                        duplicate = find_duplicate(file_path, fingerprint)
+                except Exception as e:
+                    start_job(job_id)
+                    fail_job(job_id, f"Could not read file: {e}")
+                    continue
+                if duplicate:
+                    os.remove(file_path)
+                    discard_provisional(f) # Left over from a discarded or failed live pass
+                    finish_job(job_id, duplicate)
+                    publish_saved(f, duplicate)
+                    continue
+
+                if any(entry[1] == fingerprint for entry in in_flight.values()):
+                    continue # Same content already being analyzed; caught as a duplicate once it's saved
+
+                # 2. Analyze (in a pool process, which also computes the full hash)
+                start_job(job_id)
+                future = pool.submit(analyzer.analyze_audio, file_path, MIDI_FOLDER, cache_dir=CACHE_FOLDER)
+                in_flight[future] = (f, fingerprint, timer, job_id)
+                free -= 1
+
+            # Wake up as soon as a file finishes or arrives, or for the next full scan
+            # (sooner while a live analysis may be sending provisional results, or
+            # when a file may have become stable or a failed job is due for a retry)
+            wake = watcher.wake_future()
+            timeout = 5 if any(entry[1] is None for entry in in_flight.values()) else watcher.rescan_interval
+            for t in (stability.next_check(), seconds_until_retry() if free > 0 else None):
+                if t is not None:
+                    timeout = min(timeout, t)
+            done, _ = wait(list(in_flight) + [wake], timeout=timeout, return_when=FIRST_COMPLETED)
+            done.discard(wake)
+
+            apply_events(updates)
+
+            for future in done:
+                f, fingerprint, timer, job_id = in_flight.pop(future)
+                live = fingerprint is None
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    if not live:
+                        fail_job(job_id, f"Analysis process crashed: {e}")
+                        raise
+                    print(f"Live analysis process crashed: {e}")
+                    live_pool.shutdown(wait=False, cancel_futures=True)
+                    live_pool = None
+                    unfollowable.add(f)
+                    discard_provisional(f)
+                    continue
+                except Exception as e:
+                    print(f"Analysis failed for {f}: {e}")
+                    if live:
+                        unfollowable.add(f)
+                        discard_provisional(f)
+                    else:
+                        fail_job(job_id, f"{type(e).__name__}: {e}")
+                    continue
                 if result:
-                    # 3. Calculate Start Time (Metadata Extraction)
-                    # Use mtime as end time, subtract duration to get start time
+                    if live:
+                        # Fingerprint of the finished file, for later duplicate checks
+                        file_path = os.path.join(UPLOAD_FOLDER, f)
+                        fingerprint = (os.path.getsize(file_path), get_quick_hash(file_path))
                     try:
-                        mtime = os.path.getmtime(file_path)
-                        dt_end = datetime.fromtimestamp(mtime)
-                        # result['total_duration'] is float seconds
-                        dt_start = dt_end - timedelta(seconds=result['total_duration'])
-                        
-                        # Fallback: Check filename for Date (YYMMDD prefix)
-                        # Example: 260207_0009.wav -> 2026-02-07
-                        if len(f) >= 6 and f[:6].isdigit():
-                            try:
-                                date_from_name = datetime.strptime(f[:6], '%y%m%d')
-                                # If filename date differs from mtime date, trust filename for Day
-                                if date_from_name.date() != dt_start.date():
-                                    print(f"Date correction for {f}: {dt_start.date()} -> {date_from_name.date()}")
-                                    dt_start = dt_start.replace(
-                                        year=date_from_name.year,
-                                        month=date_from_name.month,
-                                        day=date_from_name.day
-                                    )
-                            except ValueError:
-                                pass # Filename start with numbers but not a valid YYMMDD date
-
+                        save_analysis(f, result, fingerprint, timer)
                     except Exception as e:
-                        print(f"Error extracting time metadata, falling back to now: {e}")
-                        dt_start = datetime.now()
-
-                    new_session = Session(
-                        hash=file_hash,
-                        date=dt_start,
-                        filename=f,
-                        total_duration=result['total_duration'],
-                        active_duration=result['active_duration'],
-                        keystrokes=result['keystrokes'],
-                        efficiency=result['efficiency'],
-                        waveform_json=result['waveform'],
-                        intervals_json=json.dumps(result['intervals']),
-                        midi_url=result['midi_filename'] # This is just filename, frontend will prepend path
-                    )
-
-                    with app.app_context():
-                        db.session.add(new_session)
-                        db.session.commit()
-                        print(f"Saved session for {f} (Date: {dt_start})")
-
-                    # 4. Archive original file
-                    if os.path.exists(file_path):
-                        try:
-                            archive_dir = os.path.join(BASE_DIR, 'archive')
-                            os.makedirs(archive_dir, exist_ok=True)
-                            
-                            # Move file to archive directory
-                            # Preserving original filename or potential unique name if collision?
-                            # Hashes are unique, but filenames might repeat. Let's prepend hash or keep original.
-                            # Just moving for now.
-                            dest_path = os.path.join(archive_dir, f)
-                            
-                            # If destination exists, maybe rename?
-                            if os.path.exists(dest_path):
-                                base, ext = os.path.splitext(f)
-                                dest_path = os.path.join(archive_dir, f"{base}_{file_hash[:6]}{ext}")
-                                
-                            os.rename(file_path, dest_path)
-                            print(f"Archived {f} to {dest_path}")
-                        except Exception as e:
-                            print(f"Error archiving {f}: {e}")
+                        print(f"Error saving analysis of {f}: {e}")
+                        if not live:
+                            fail_job(job_id, f"Saving failed: {e}")
+                        continue
+                    if not live:
+                        finish_job(job_id, result['hash'])
+                elif live:
+                    # The live pass doesn't match the finished file; analyze it normally once it's stable
+                    print(f"Live analysis of {f} discarded, analyzing the finished file instead")
+                    unfollowable.add(f)
                 else:
                      print(f"Analysis failed for {f}")
+                     fail_job(job_id, "Analysis returned no result")
 
+        except BrokenProcessPool as e:
+            # A pool process died (e.g. out of memory); its jobs are retried with backoff
+            print(f"Analysis pool crashed, restarting: {e}")
+            for f, fingerprint, timer, job_id in in_flight.values():
+                if job_id is not None:
+                    fail_job(job_id, f"Analysis process crashed: {e}")
+            in_flight = {fu: v for fu, v in in_flight.items() if v[3] is None} # Live recordings run in their own pool
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = create_analysis_pool(events)
         except Exception as e:
             print(f"Worker error: {e}")
+            time.sleep(5)
+
+def is_recording(file_path):
+    """
+    Whether a WAV is still being recorded: recorders leave a placeholder data
+    size in the header until they stop, while a copy has the final header.
+    """
+    try:
+        with analyzer.GrowingWav(file_path) as wav:
+            return wav.data_frames() is None
+    except (OSError, EOFError, ValueError, struct.error):
+        return False
+
+def sync_jobs(ready):
+    """
+    Gives every stable file in uploads/ (name -> os.stat result) an unfinished
+    Job for its current version: new files get a pending job, and a file that
+    changed since its job was made (e.g. a failed file replaced) starts over.
+    Pending and failed jobs whose file is gone are dropped.
+    """
+    with app.app_context():
+        active = {j.filename: j for j in Job.query.filter(Job.state != 'done').order_by(Job.id)}
+        queued = []
+        for f, st in ready.items():
+            job = active.get(f)
+            if job is None:
+                job = Job(filename=f, state='pending', priority=0)
+                db.session.add(job)
+            elif job.state == 'running':
+                continue
+            elif (job.file_size, job.file_mtime) != (st.st_size, st.st_mtime):
+                job.state = 'pending'
+                job.attempts = 0
+                job.last_error = None
+                job.next_attempt_at = None
+            elif job.recorded_at is not None:
+                continue # Unchanged, and its scheduling keys are known
+            # Scheduling keys, from the header and mtime only
+            file_path = os.path.join(UPLOAD_FOLDER, f)
+            job.file_size, job.file_mtime = st.st_size, st.st_mtime
+            job.duration = analyzer.wav_duration(file_path)
+            job.recorded_at = recording_start(f, file_path, job.duration or 0)
+            queued.append(job)
+        for f, job in active.items():
+            if job.state in ('pending', 'failed') and not os.path.exists(os.path.join(UPLOAD_FOLDER, f)):
+                db.session.delete(job)
+                publish('discarded', file=f)
+        db.session.commit()
+        for job in queued:
+            if job.state == 'pending':
+                publish('queued', file=job.filename, job=job.to_dict())
+
+def recover_jobs():
+    """
+    Jobs left running by a previous run (crash or restart) go back to pending;
+    their attempt still counts. Pending jobs are announced to /api/events.
+    """
+    with app.app_context():
+        for job in Job.query.filter_by(state='running'):
+            print(f"Job for {job.filename} was interrupted, requeueing")
+            job.state = 'pending'
+        db.session.commit()
+        for job in Job.query.filter_by(state='pending'):
+            publish('queued', file=job.filename, job=job.to_dict())
+
+def job_order():
+    """ORDER BY clauses for claiming pending jobs: pinned first, then by JOB_ORDER, then by arrival."""
+    order = [Job.priority.desc()]
+    if JOB_ORDER == 'newest':
+        order += [Job.recorded_at.is_(None), Job.recorded_at.desc()]
+    elif JOB_ORDER == 'shortest':
+        order += [Job.duration.is_(None), Job.duration]
+    return order + [Job.created_at, Job.id]
+
+def next_job(exclude):
+    """The pending job to analyze next (see job_order) whose retry time has come, as (id, filename), or None."""
+    with app.app_context():
+        query = Job.query.filter(Job.state == 'pending',
+                                 db.or_(Job.next_attempt_at.is_(None), Job.next_attempt_at <= datetime.now()))
+        if exclude:
+            query = query.filter(Job.filename.notin_(exclude))
+        job = query.order_by(*job_order()).first()
+        return (job.id, job.filename) if job else None
+
+def seconds_until_retry():
+    """Seconds until the next pending job waiting out a backoff is due, or None."""
+    with app.app_context():
+        due = db.session.query(db.func.min(Job.next_attempt_at)).filter(
+            Job.state == 'pending', Job.next_attempt_at > datetime.now()).scalar()
+    return max(0.0, (due - datetime.now()).total_seconds()) if due else None
+
+def start_job(job_id):
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        job.state = 'running'
+        job.attempts = (job.attempts or 0) + 1
+        job.started_at = datetime.now()
+        job.finished_at = None
+        db.session.commit()
+        # The only "decoding" event: pool processes report transcription progress from here on
+        publish('decoding', file=job.filename, percent=0.0)
+
+def finish_job(job_id, session_hash):
+    """Marks a job done; session_hash is the Session it produced (or the existing one it duplicates)."""
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        job.state = 'done'
+        job.session_hash = session_hash
+        job.last_error = None
+        job.next_attempt_at = None
+        job.finished_at = datetime.now()
+        db.session.commit()
+
+def fail_job(job_id, error):
+    """
+    Records a failed attempt. The job is retried after JOB_RETRY_SECONDS,
+    doubling with each attempt, and marked failed after JOB_MAX_ATTEMPTS.
+    """
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        job.last_error = error
+        job.finished_at = datetime.now()
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            job.state = 'failed'
+            job.next_attempt_at = None
+            print(f"Giving up on {job.filename} after {job.attempts} attempts: {error}")
+        else:
+            job.state = 'pending'
+            delay = JOB_RETRY_SECONDS * 2 ** (job.attempts - 1)
+            job.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+            print(f"Will retry {job.filename} in {delay} s (attempt {job.attempts} of {JOB_MAX_ATTEMPTS} failed)")
+        db.session.commit()
+        publish('failed', file=job.filename, job=job.to_dict())
+
+def find_duplicate(file_path, fingerprint):
+    """
+    Returns the hash of an existing Session with the same content, or None.
+    Files whose (size, quick hash) matches no Session are new without reading
+    them in full; only a fingerprint match is confirmed with the full hash.
+    """
+    file_size, quick_hash = fingerprint
+    with app.app_context():
+        candidates = [h for (h,) in db.session.query(Session.hash).filter_by(file_size=file_size, quick_hash=quick_hash)]
+    if not candidates:
+        return None
+
+    file_hash = get_file_hash(file_path)
+    if file_hash in candidates:
+        print(f"Duplicate file {os.path.basename(file_path)} (Hash: {file_hash}). Skipping.")
+        return file_hash
+    return None
+
+def backfill_fingerprints():
+    """Fills in file_size/quick_hash for sessions saved before fingerprints existed, from their archived files."""
+    with app.app_context():
+        sessions = Session.query.filter(Session.quick_hash.is_(None)).all()
+        for s in sessions:
+            base, ext = os.path.splitext(s.filename)
+            for name in (s.filename, f"{base}_{s.hash[:6]}{ext}"):
+                archive_path = os.path.join(BASE_DIR, 'archive', name)
+                if os.path.exists(archive_path) and get_file_hash(archive_path) == s.hash:
+                    s.file_size = os.path.getsize(archive_path)
+                    s.quick_hash = get_quick_hash(archive_path)
+                    print(f"Fingerprinted {s.filename}")
+                    break
+            # Sessions without an archived copy keep no fingerprint; a re-upload is
+            # then caught by the hash check in save_analysis instead
+        db.session.commit()
+
+def save_analysis(f, result, fingerprint, timer=None):
+    """
+    Stores an analysis result as a Session and archives the uploaded file.
+    Stage timings (from the analysis, plus `timer` and the DB write here) go to SessionTiming.
+    """
+    file_path = os.path.join(UPLOAD_FOLDER, f)
+    file_hash = result['hash']
+    timer = timer or analyzer.StageTimer(cpu_clock=time.thread_time)
+
+    with app.app_context():
+        if db.session.get(Session, file_hash):
+            # Identical content was saved while this one was being analyzed
+            print(f"Duplicate file {f} (Hash: {file_hash}). Skipping.")
+            os.remove(file_path)
+            discard_provisional(f)
+            publish_saved(f, file_hash)
+            return
+
+    # 3. Calculate Start Time (Metadata Extraction)
+    dt_start = recording_start(f, file_path, result['total_duration'])
+
+    new_session = Session(
+        hash=file_hash,
+        date=dt_start,
+        filename=f,
+        total_duration=result['total_duration'],
+        active_duration=result['active_duration'],
+        keystrokes=result['keystrokes'],
+        efficiency=result['efficiency'],
+        waveform_blob=result['waveform'],
+        intervals_json=json.dumps(result['intervals']),
+        midi_url=result['midi_filename'], # This is just filename, frontend will prepend path
+        file_size=fingerprint[0],
+        quick_hash=fingerprint[1]
+    )
+
+    with app.app_context(), timer.stage('db_write'):
+        # Replaces the provisional row of a recording that was analyzed live
+        Session.query.filter_by(hash=provisional_hash(f)).delete()
+        db.session.add(new_session)
+        db.session.commit()
+        print(f"Saved session for {f} (Date: {dt_start})")
+        publish('saved', file=f, session=new_session.to_dict(), replaces=provisional_hash(f))
+
+    save_timings(file_hash, {**result.get('timings', {}), **timer.stages})
+
+    # 4. Archive original file
+    if os.path.exists(file_path):
+        try:
+            archive_dir = os.path.join(BASE_DIR, 'archive')
+            os.makedirs(archive_dir, exist_ok=True)
+            
+            # Move file to archive directory
+            # Preserving original filename or potential unique name if collision?
+            # Hashes are unique, but filenames might repeat. Let's prepend hash or keep original.
+            # Just moving for now.
+            dest_path = os.path.join(archive_dir, f)
+            
+            # If destination exists, maybe rename?
+            if os.path.exists(dest_path):
+                base, ext = os.path.splitext(f)
+                dest_path = os.path.join(archive_dir, f"{base}_{file_hash[:6]}{ext}")
+                
+            os.rename(file_path, dest_path)
+            print(f"Archived {f} to {dest_path}")
+        except Exception as e:
+            print(f"Error archiving {f}: {e}")
+
+def publish_saved(f, session_hash):
+    """Publishes the Session an upload ended up as (for duplicates, the existing one)."""
+    with app.app_context():
+        s = db.session.get(Session, session_hash)
+        publish('saved', file=f, session=s.to_dict() if s else None, replaces=provisional_hash(f))
+
+def recording_start(f, file_path, duration):
+    """
+    Start time of a recording: its mtime (when recording stopped) minus its
+    duration, with the day taken from a YYMMDD filename prefix if that differs.
+    """
+    # Use mtime as end time, subtract duration to get start time
+    try:
+        mtime = os.path.getmtime(file_path)
+        dt_end = datetime.fromtimestamp(mtime)
+        dt_start = dt_end - timedelta(seconds=duration)
         
-        time.sleep(5) # Check every 5 seconds
+        # Fallback: Check filename for Date (YYMMDD prefix)
+        # Example: 260207_0009.wav -> 2026-02-07
+        if len(f) >= 6 and f[:6].isdigit():
+            try:
+                date_from_name = datetime.strptime(f[:6], '%y%m%d')
+                # If filename date differs from mtime date, trust filename for Day
+                if date_from_name.date() != dt_start.date():
+                    print(f"Date correction for {f}: {dt_start.date()} -> {date_from_name.date()}")
+                    dt_start = dt_start.replace(
+                        year=date_from_name.year,
+                        month=date_from_name.month,
+                        day=date_from_name.day
+                    )
+            except ValueError:
+                pass # Filename start with numbers but not a valid YYMMDD date
+
+    except Exception as e:
+        print(f"Error extracting time metadata, falling back to now: {e}")
+        dt_start = datetime.now()
+    return dt_start
+
+def provisional_hash(f):
+    """Session key of a recording's provisional row (its content hash isn't known until it's finished)."""
+    return 'live-' + hashlib.sha256(f.encode()).hexdigest()[:59]
+
+def save_provisional(f, update):
+    """Creates or updates the provisional Session of a recording that is still being written."""
+    file_path = os.path.join(UPLOAD_FOLDER, f)
+    with app.app_context():
+        s = db.session.get(Session, provisional_hash(f))
+        if s is None:
+            s = Session(hash=provisional_hash(f), filename=f, provisional=True)
+            db.session.add(s)
+        s.date = recording_start(f, file_path, update['total_duration'])
+        s.total_duration = update['total_duration']
+        s.active_duration = update['active_duration']
+        s.keystrokes = update['keystrokes']
+        s.efficiency = update['efficiency']
+        s.waveform_blob = update['waveform']
+        s.intervals_json = json.dumps(update['intervals'])
+        db.session.commit()
+        publish('provisional', file=f, session=s.to_dict())
+
+def discard_provisional(f):
+    with app.app_context():
+        if Session.query.filter_by(hash=provisional_hash(f)).delete():
+            publish('discarded', file=f, hash=provisional_hash(f))
+        db.session.commit()
+
+def apply_events(updates):
+    """Saves the provisional results relay_events has received so far."""
+    while True:
+        try:
+            event = updates.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            if event['event'] == 'provisional':
+                save_provisional(event['file'], event)
+                print(f"Live: {event['file']} at {event['total_duration'] / 60:.1f} min, {event['keystrokes']} keystrokes so far")
+        except Exception as e:
+            print(f"Error applying {event.get('event')} event: {e}")
+
+def save_timings(file_hash, timings):
+    """Replaces the stored stage timings of a session."""
+    try:
+        with app.app_context():
+            SessionTiming.query.filter_by(session_hash=file_hash).delete()
+            for stage, t in timings.items():
+                db.session.add(SessionTiming(session_hash=file_hash, stage=stage, wall=t['wall'], cpu=t['cpu']))
+            db.session.commit()
+    except Exception as e:
+        print(f"Error saving timings for {file_hash}: {e}")
 
 # External Drive Sync Worker
 def scan_external_drives():
@@ -280,12 +847,13 @@ def scan_external_drives():
             
         time.sleep(10) # Scan every 10 seconds
 
-# Start Workers
-worker_thread = threading.Thread(target=process_uploads, daemon=True)
-worker_thread.start()
+# Start Workers (skipped when analysis pool processes re-import this module as __mp_main__)
+if __name__ != '__mp_main__':
+    worker_thread = threading.Thread(target=process_uploads, daemon=True)
+    worker_thread.start()
 
-scanner_thread = threading.Thread(target=scan_external_drives, daemon=True)
-scanner_thread.start()
+    scanner_thread = threading.Thread(target=scan_external_drives, daemon=True)
+    scanner_thread.start()
 
 # Routes
 @app.route('/')
@@ -378,6 +946,80 @@ def get_sessions():
         print(f"Error in get_sessions: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/events')
+def event_stream():
+    """
+    Server-sent events with ingestion progress (see publish); each message's
+    data is the event as JSON. Files still queued or being analyzed are sent
+    first, so a new page knows what's in progress.
+    """
+    q = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with _subscribers_lock:
+        backlog = list(_in_progress.values())
+        _subscribers.append(q)
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            for message in backlog:
+                yield f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+            while True:
+                try:
+                    message = q.get(timeout=EVENT_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n' # Also how a closed connection is noticed
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            with _subscribers_lock:
+                _subscribers.remove(q)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/session/<hash_id>/waveform')
+def get_session_waveform(hash_id):
+    """
+    Envelope of a session as a single-level blob (see analyzer.encode_waveform_level).
+    With ?width=N (pixels), the coarsest level that still has N samples over the
+    range ?start=..&end=.. (seconds, default the whole recording); without it,
+    the finest level. X-Waveform-Start gives the time of the first sample.
+    """
+    try:
+        width = int(request.args.get('width', 0))
+        start = float(request.args.get('start', 0))
+        end = float(request.args['end']) if 'end' in request.args else None
+        if not math.isfinite(start) or (end is not None and not math.isfinite(end)):
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "width, start and end must be numbers"}), 400
+    start = max(0.0, start)
+    if end is not None and end <= start:
+        return jsonify({"error": "end must be after start"}), 400
+
+    s = db.session.get(Session, hash_id)
+    if not s:
+        return jsonify({"error": "Not found"}), 404
+
+    if s.waveform_blob is None:
+        if not s.waveform_json:
+            return jsonify({"error": "No waveform"}), 404
+        # Legacy row: convert once and drop the JSON copy
+        s.waveform_blob = encode_waveform(json.loads(s.waveform_json))
+        s.waveform_json = None
+        db.session.commit()
+    elif s.waveform_blob[0] != analyzer.WAVEFORM_PYRAMID_VERSION:
+        # Single-level blob from before pyramids: build the coarser levels once
+        s.waveform_blob = waveform_pyramid(s.waveform_blob)
+        db.session.commit()
+
+    rate, first, samples = select_waveform_level(s.waveform_blob, width if width > 0 else float('inf'), start, end)
+    blob = encode_waveform_level(samples, rate)
+    response = Response(blob, mimetype='application/octet-stream')
+    response.headers['X-Waveform-Start'] = str(first / rate)
+    response.set_etag(hashlib.md5(blob).hexdigest())
+    return response.make_conditional(request)
+
 @app.route('/api/stats')
 def get_stats():
     # Get date from query param or use today
@@ -459,6 +1101,10 @@ def admin_page():
 @app.route('/api/admin/sessions')
 def admin_list_sessions():
     sessions = Session.query.order_by(Session.date.desc()).all()
+    cached = analyzer.cached_hashes(CACHE_FOLDER)
+    timings = {}
+    for t in SessionTiming.query.all():
+        timings.setdefault(t.session_hash, {})[t.stage] = {"wall": t.wall, "cpu": t.cpu}
     result = []
     
     # Simple cache for archive check performance if many files?
@@ -477,7 +1123,9 @@ def admin_list_sessions():
             "total_duration": s.total_duration,
             "active_duration": s.active_duration,
             "keystrokes": s.keystrokes,
-            "has_archive": os.path.exists(archive_path)
+            "has_archive": os.path.exists(archive_path),
+            "has_cache": s.hash in cached,
+            "timings": timings.get(s.hash, {})
         })
     return jsonify(result)
 
@@ -495,6 +1143,7 @@ def admin_delete_session(hash_id):
                  try: os.remove(midi_path)
                  except: pass
         
+        SessionTiming.query.filter_by(session_hash=s.hash).delete()
         db.session.delete(s)
         db.session.commit()
         return jsonify({"success": True})
@@ -523,6 +1172,7 @@ def admin_reprocess_session(hash_id):
                      try: os.remove(midi_path)
                      except: pass
 
+            SessionTiming.query.filter_by(session_hash=s.hash).delete()
             db.session.delete(s)
             db.session.commit()
             
@@ -561,9 +1211,99 @@ def admin_recalc_stats(hash_id):
         else:
             return jsonify({"error": "Recalculation failed"}), 500
 
+@app.route('/api/admin/session/<hash_id>/reextract', methods=['POST'])
+def admin_reextract(hash_id):
+    """
+    Regenerates notes, MIDI and stats from the cached model posteriors, without
+    re-running the model. Optional JSON body: onset_threshold, frame_threshold,
+    minimum_note_length_ms (defaults: the analyzer's current settings).
+    """
+    global _extraction_pool
+    with app.app_context():
+        s = db.session.get(Session, hash_id)
+        if not s:
+             return jsonify({"error": "Not found"}), 404
+
+        params = request.get_json(silent=True) or {}
+        try:
+            thresholds = {
+                key: float(params[key])
+                for key in ('onset_threshold', 'frame_threshold', 'minimum_note_length_ms')
+                if key in params
+            }
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid threshold"}), 400
+
+        midi_filename = s.midi_url or os.path.splitext(s.filename)[0] + "_basic_pitch.mid"
+        try:
+            future = get_extraction_pool().submit(
+                analyzer.reextract_metrics, CACHE_FOLDER, s.hash, os.path.join(MIDI_FOLDER, midi_filename), **thresholds
+            )
+            metrics = future.result()
+        except BrokenProcessPool as e:
+            _extraction_pool = None # Recreated on next use
+            print(f"Re-extraction error: {e}")
+            return jsonify({"error": str(e)}), 500
+        except Exception as e:
+            print(f"Re-extraction error: {e}")
+            return jsonify({"error": str(e)}), 500
+
+        if metrics is None:
+            return jsonify({"error": "No cached analysis (use full reprocess)"}), 404
+
+        s.active_duration = metrics['active_duration']
+        s.efficiency = metrics['efficiency']
+        s.keystrokes = metrics['keystrokes']
+        s.intervals_json = json.dumps(metrics['intervals'])
+        s.midi_url = midi_filename
+        db.session.commit()
+        return jsonify({"success": True, "keystrokes": s.keystrokes})
+
+@app.route('/api/admin/jobs')
+def admin_list_jobs():
+    """Unfinished ingestion jobs (pending, running, failed), in the order they will be analyzed."""
+    jobs = Job.query.filter(Job.state != 'done').order_by(*job_order()).all()
+    return jsonify([j.to_dict() for j in jobs])
+
+@app.route('/api/admin/job/<int:job_id>/retry', methods=['POST'])
+def admin_retry_job(job_id):
+    """Requeues a failed (or backing-off) job now, with a fresh set of attempts."""
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    if job.state not in ('failed', 'pending'):
+        return jsonify({"error": f"Job is {job.state}"}), 400
+    if not os.path.exists(os.path.join(UPLOAD_FOLDER, job.filename)):
+        return jsonify({"error": "File no longer in 'uploads/'"}), 400
+
+    job.state = 'pending'
+    job.attempts = 0
+    job.next_attempt_at = None
+    job.last_error = None
+    db.session.commit()
+    publish('queued', file=job.filename, job=job.to_dict())
+    if _upload_watcher:
+        _upload_watcher.wake()
+    return jsonify({"success": True})
+
+@app.route('/api/admin/job/<int:job_id>/pin', methods=['POST'])
+def admin_pin_job(job_id):
+    """Pins a pending job to the front of the queue (JSON body {"pinned": false} unpins it)."""
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    if job.state != 'pending':
+        return jsonify({"error": f"Job is {job.state}"}), 400
+
+    params = request.get_json(silent=True) or {}
+    job.priority = 1 if params.get('pinned', True) else 0
+    db.session.commit()
+    return jsonify({"success": True, "priority": job.priority})
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        upgrade_schema()
     
     # Get local IP for convenience
     import socket
@@ -0,0 +1,9 @@
+"""
+Benchmarks for the analysis pipeline.
+
+Run from the project root, e.g.:
+    python -m benchmarks.run --output report.json   (whole pipeline, per stage)
+    python -m benchmarks.bench_decode --minutes 60
+    python -m benchmarks.bench_memory --minutes 10 30   (peak RSS of a long analysis)
+    python -m benchmarks.bench_backends --threads 0 1 2    (inference backends and thread counts)
+"""
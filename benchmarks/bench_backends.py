@@ -0,0 +1,87 @@
+"""
+Compares the model inference backends (SONATA_MODEL_BACKEND) and thread
+settings on this machine: load time, memory and transcription speed on a
+synthetic recording, plus agreement of the note posteriors with TensorFlow.
+
+Each backend/thread combination runs in its own process, as an analysis
+worker would.
+
+    python -m benchmarks.bench_backends --backends tf onnx tflite --threads 0 1 2
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _run_child(path, posteriors_path):
+    sys.path.insert(0, BASE_DIR)
+    start = time.perf_counter()
+    import analyzer
+    analyzer.warm_up_model()
+    load = time.perf_counter() - start
+
+    y, sr, y_model = analyzer.load_audio(path)
+    start, cpu = time.perf_counter(), time.process_time()
+    output = analyzer.run_model(y_model)
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+    np.save(posteriors_path, output['note'])
+
+    print(json.dumps({
+        'load': load,
+        'wall': wall,
+        'cpu': cpu,
+        'audio_seconds': len(y_model) / analyzer.AUDIO_SAMPLE_RATE,
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'tensorflow': sys.modules.get('tensorflow') is not None,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['tf', 'tflite', 'onnx'])
+    parser.add_argument('--threads', type=int, nargs='+', default=[0, 1], help='intra-op thread counts to try (0 = runtime default)')
+    parser.add_argument('--inter-op-threads', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=120)
+    parser.add_argument('--child', nargs=2, metavar=('AUDIO', 'POSTERIORS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_child(*args.child)
+        return
+
+    from benchmarks.synth import make_recording
+
+    reference = None
+    with tempfile.TemporaryDirectory() as tmp:
+        path = make_recording(os.path.join(tmp, 'backends.wav'), duration=args.seconds, sr=44100)
+        for backend in args.backends:
+            for threads in args.threads:
+                posteriors_path = os.path.join(tmp, f'{backend}_{threads}.npy')
+                env = dict(os.environ, SONATA_MODEL_BACKEND=backend,
+                           SONATA_INTRA_OP_THREADS=str(threads), SONATA_INTER_OP_THREADS=str(args.inter_op_threads))
+                out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_backends', '--child', path, posteriors_path],
+                                     cwd=BASE_DIR, env=env, capture_output=True, text=True)
+                if out.returncode != 0:
+                    print(f"{backend:<7} threads {threads}: failed ({out.stderr.strip().splitlines()[-1]})")
+                    continue
+                result = json.loads(out.stdout.strip().splitlines()[-1])
+
+                note = np.load(posteriors_path)
+                if reference is None:
+                    reference = note
+                diff = float(np.max(np.abs(note - reference)))
+                print(f"{backend:<7} threads {threads}: load {result['load']:5.1f} s, "
+                      f"{result['audio_seconds'] / result['wall']:6.1f}x realtime "
+                      f"(cpu {result['cpu'] / result['wall']:4.1f} cores), peak RSS {result['peak_mb']:5.0f} MB, "
+                      f"TensorFlow {'loaded' if result['tensorflow'] else 'not loaded'}, "
+                      f"max |note - first| {diff:.1e}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Compares the old double decode (librosa.load at the native rate, then
+again at the model rate, as basic_pitch did from the file path) with
+analyzer.load_audio (one decode plus one resample), and the separate
+content hash before decoding with analyzer.load_audio_hashed (hash computed
+from the decoder's reads).
+
+Each variant runs in its own process so peak RSS is measured in isolation.
+"Read" is the bytes read by the process (/proc/self/io rchar) relative to
+the file size.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _bytes_read():
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    return 0
+
+VARIANTS = ('double', 'single', 'hash+single', 'hashed')
+
+def _run_variant(variant, path):
+    sys.path.insert(0, BASE_DIR)
+    import librosa
+    from basic_pitch.constants import AUDIO_SAMPLE_RATE
+    import analyzer
+
+    # Trigger librosa's lazy imports up front so their file reads aren't counted
+    import numpy as np
+    librosa.resample(np.zeros(AUDIO_SAMPLE_RATE, dtype=np.float32), orig_sr=AUDIO_SAMPLE_RATE * 2, target_sr=AUDIO_SAMPLE_RATE)
+
+    baseline_rss = _peak_rss_mb()
+    baseline_read = _bytes_read()
+    start = time.perf_counter()
+    if variant == 'double':
+        y, sr = librosa.load(path, sr=None)
+        y_model, _ = librosa.load(path, sr=AUDIO_SAMPLE_RATE)
+    elif variant == 'single':
+        y, sr, y_model = analyzer.load_audio(path)
+    elif variant == 'hash+single':
+        file_hash = analyzer.get_file_hash(path)
+        y, sr, y_model = analyzer.load_audio(path)
+    else:
+        y, sr, y_model, file_hash = analyzer.load_audio_hashed(path)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({
+        'variant': variant,
+        'seconds': elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'import_rss_mb': baseline_rss,
+        'read_ratio': (_bytes_read() - baseline_read) / os.path.getsize(path),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--minutes', type=float, nargs='+', default=[10, 60])
+    parser.add_argument('--sr', type=int, default=48000)
+    parser.add_argument('--child', nargs=2, metavar=('VARIANT', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_variant(*args.child)
+        return
+
+    from benchmarks.synth import make_recording
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutes in args.minutes:
+            path = make_recording(os.path.join(tmp, f'decode_{minutes:g}min.wav'), duration=minutes * 60, sr=args.sr)
+            for variant in VARIANTS:
+                out = subprocess.run(
+                    [sys.executable, '-m', 'benchmarks.bench_decode', '--child', variant, path],
+                    cwd=BASE_DIR, capture_output=True, text=True, check=True,
+                )
+                result = json.loads(out.stdout.strip().splitlines()[-1])
+                print(f"{minutes:>6g} min  {variant:<11} {result['seconds']:7.2f} s  peak RSS {result['peak_rss_mb']:7.0f} MB  read {result['read_ratio']:.2f}x")
+
+if __name__ == '__main__':
+    main()
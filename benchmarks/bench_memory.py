@@ -0,0 +1,83 @@
+"""
+Peak memory of analyze_audio's in-memory path on long synthetic recordings.
+
+Each length runs in its own process. The model is loaded and warmed up
+first, so the reported figure is the peak RSS added by the analysis itself
+(what an extra pool worker costs beyond its model). With --max-mb-per-minute
+the run fails (exit status 1) if any recording exceeds that budget.
+
+    python -m benchmarks.bench_memory --minutes 10 30 --max-mb-per-minute 40
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_child(path, streaming):
+    sys.path.insert(0, BASE_DIR)
+    import analyzer
+
+    # Untimed warm-up on a short file, so model and lazy imports aren't counted
+    from benchmarks.synth import make_recording
+    with tempfile.TemporaryDirectory() as tmp:
+        analyzer.analyze_audio(make_recording(os.path.join(tmp, 'warmup.wav'), duration=5.0), None, streaming=False)
+
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    result = analyzer.analyze_audio(path, None, streaming=streaming)
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'baseline_mb': baseline,
+        'peak_mb': _peak_rss_mb(),
+        'keystrokes': result['keystrokes'],
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, nargs='+', default=[10, 30])
+    parser.add_argument('--sr', type=int, default=48000)
+    parser.add_argument('--streaming', action='store_true', help='measure the streaming path instead')
+    parser.add_argument('--max-mb-per-minute', type=float, help='fail if the analysis adds more than this per minute of audio')
+    parser.add_argument('--child', metavar='PATH', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_child(args.child, args.streaming)
+        return
+
+    from benchmarks.synth import make_recording
+
+    over_budget = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutes in args.minutes:
+            path = make_recording(os.path.join(tmp, f'memory_{minutes:g}min.wav'), duration=minutes * 60, sr=args.sr)
+            command = [sys.executable, '-m', 'benchmarks.bench_memory', '--child', path]
+            if args.streaming:
+                command.append('--streaming')
+            out = subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True, check=True)
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+
+            added = result['peak_mb'] - result['baseline_mb']
+            per_minute = added / minutes
+            status = ''
+            if args.max_mb_per_minute is not None and per_minute > args.max_mb_per_minute:
+                status = '  OVER BUDGET'
+                over_budget = True
+            print(f"{minutes:>6g} min @ {args.sr} Hz: {result['seconds']:7.1f} s, peak RSS {result['peak_mb']:7.0f} MB "
+                  f"(+{added:.0f} MB over the warm model, {per_minute:.1f} MB/min){status}")
+
+    if over_budget:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
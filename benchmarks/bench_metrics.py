@@ -0,0 +1,95 @@
+"""
+Checks analyzer.calculate_metrics_from_notes against the original
+sequential interval merge on randomized note sets (results must be
+exactly equal) and times both.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analyzer
+
+def calculate_metrics_loop(notes, duration_orig):
+    """The original pairwise merge loop, kept here as the reference."""
+    valid = notes["velocity"] >= analyzer.MIN_VELOCITY
+    keystrokes = int(np.count_nonzero(valid))
+    starts = notes["start"][valid]
+    ends = notes["end"][valid]
+    sounding = ends > starts
+    valid_raw_intervals = list(zip(starts[sounding].tolist(), ends[sounding].tolist()))
+
+    intervals_sec = []
+    active_duration_midi = 0.0
+    efficiency_midi = 0.0
+    if valid_raw_intervals:
+        valid_raw_intervals.sort(key=lambda x: x[0])
+        merged = []
+        curr_start, curr_end = valid_raw_intervals[0]
+        for next_start, next_end in valid_raw_intervals[1:]:
+            if next_start - curr_end <= analyzer.GAP_THRESHOLD:
+                curr_end = max(curr_end, next_end)
+            else:
+                merged.append([max(0, curr_start - analyzer.INTERVAL_PADDING), min(duration_orig, curr_end + analyzer.INTERVAL_PADDING)])
+                curr_start, curr_end = next_start, next_end
+        merged.append([max(0, curr_start - analyzer.INTERVAL_PADDING), min(duration_orig, curr_end + analyzer.INTERVAL_PADDING)])
+        intervals_sec = merged
+        active_duration_midi = sum(end - start for start, end in merged)
+        efficiency_midi = (active_duration_midi / duration_orig) if duration_orig > 0 else 0
+
+    return {
+        "active_duration": active_duration_midi,
+        "efficiency": efficiency_midi,
+        "keystrokes": keystrokes,
+        "intervals": intervals_sec,
+    }
+
+def random_notes(n, duration, rng):
+    """Random notes in shuffled order, with start ties (coarse rounding) and some zero-length notes."""
+    start = np.round(rng.uniform(0, duration, n), int(rng.integers(0, 4)))
+    length = rng.exponential(0.4, n) * (rng.random(n) > 0.02)
+    return {
+        "start": start,
+        "end": start + length,
+        "pitch": rng.integers(21, 109, n).astype(np.int16),
+        "velocity": rng.integers(20, 128, n).astype(np.int16),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    # Correctness on many small/medium random cases
+    for trial in range(args.trials):
+        n = int(rng.integers(0, 300))
+        duration = float(rng.uniform(1, 600))
+        notes = random_notes(n, duration, rng)
+        expected = calculate_metrics_loop(notes, duration)
+        actual = analyzer.calculate_metrics_from_notes(notes, duration)
+        if actual != expected:
+            print(f"MISMATCH in trial {trial} (n={n}, duration={duration})")
+            sys.exit(1)
+    print(f"{args.trials} randomized trials: identical")
+
+    # Timing on dense practice
+    for n in args.sizes:
+        duration = n / 4.0 # ~4 notes per second
+        notes = random_notes(n, duration, rng)
+        start = time.perf_counter()
+        expected = calculate_metrics_loop(notes, duration)
+        t_loop = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = analyzer.calculate_metrics_from_notes(notes, duration)
+        t_vec = time.perf_counter() - start
+        status = 'identical' if actual == expected else 'MISMATCH'
+        print(f"{n:>7} notes: loop {t_loop * 1000:8.1f} ms, vectorized {t_vec * 1000:6.1f} ms ({t_loop / t_vec:5.1f}x), {status}")
+
+if __name__ == '__main__':
+    main()
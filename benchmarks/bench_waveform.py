@@ -0,0 +1,54 @@
+"""
+Times analyzer.generate_waveform_data against the original per-window
+list comprehension (which produced a JSON list) on long synthetic
+signals, and checks the envelope values are identical.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import analyzer
+
+def generate_waveform_data_loop(y, sr):
+    """The pre-vectorization implementation, kept here as the reference."""
+    hop_length = max(1, sr // 100)
+    envelope = [float(np.max(np.abs(y[i:i+hop_length]))) for i in range(0, len(y), hop_length)]
+    return json.dumps(envelope)
+
+def _signal(hours, sr, seed=0):
+    rng = np.random.default_rng(seed)
+    y = rng.standard_normal(int(hours * 3600 * sr), dtype=np.float32)
+    y *= 0.1
+    return y
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hours', type=float, nargs='+', default=[1, 3])
+    parser.add_argument('--sr', type=int, default=44100)
+    args = parser.parse_args()
+
+    for hours in args.hours:
+        y = _signal(hours, args.sr)
+
+        start = time.perf_counter()
+        reference = generate_waveform_data_loop(y, args.sr)
+        t_loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        blob = analyzer.generate_waveform_data(y, args.sr)
+        t_vec = time.perf_counter() - start
+
+        envelope = analyzer.waveform_envelope(y, max(1, args.sr // 100))
+        status = 'identical' if json.dumps(envelope.tolist()) == reference else 'MISMATCH'
+        print(f"{hours:>4g} h @ {args.sr} Hz: loop {t_loop:7.2f} s, vectorized {t_vec:6.2f} s "
+              f"({t_loop / t_vec:5.1f}x), envelope {status}, "
+              f"storage {len(reference) / 1024:.0f} KB JSON -> {len(blob) / 1024:.0f} KB blob")
+        del y, reference, blob, envelope
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Stage-by-stage benchmark of the analysis pipeline on synthetic recordings.
+
+Each case renders a deterministic recording (see synth.make_recording), then
+times the stages analyze_audio runs on it: hash, decode, RMS (silence
+gating), envelope, transcription, MIDI write + parse, and interval merge.
+Wall and CPU time are recorded per stage, after an untimed warm-up run. Results go to a JSON report, and --compare checks a report
+from an earlier version for regressions (exit status 1 if any).
+
+    python -m benchmarks.run --output report.json
+    python -m benchmarks.run --cases short dense --compare report.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import analyzer
+from benchmarks.synth import make_recording
+
+# name -> make_recording parameters
+CASES = {
+    'short': dict(duration=60, sr=44100, note_density=4.0, silence_ratio=0.3),
+    'long': dict(duration=900, sr=48000, note_density=4.0, silence_ratio=0.3),
+    'dense': dict(duration=180, sr=44100, note_density=12.0, silence_ratio=0.0),
+    'sparse': dict(duration=600, sr=44100, note_density=1.0, silence_ratio=0.7),
+    'model_rate': dict(duration=180, sr=analyzer.AUDIO_SAMPLE_RATE, note_density=4.0, silence_ratio=0.3),
+}
+STAGES = ('hash', 'decode', 'rms', 'envelope', 'transcription', 'midi', 'merge')
+
+# --compare: a stage is a regression if it got this much slower...
+REGRESSION_RATIO = 1.2
+# ...and took at least this long (seconds) before, so timer noise doesn't count
+REGRESSION_MIN_SECONDS = 0.05
+
+def _timed(stages, name, fn, *args, **kwargs):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn(*args, **kwargs)
+    stages[name] = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+    return result
+
+def _gate(y_norm, sr):
+    import librosa
+
+    rms = analyzer.frame_rms(y_norm)
+    if len(rms) == 0 or np.max(rms) == 0:
+        return []
+    return analyzer.find_active_spans(librosa.amplitude_to_db(rms, ref=np.max), analyzer.RMS_HOP_LENGTH / sr)
+
+def _midi_round_trip(notes, midi_path):
+    analyzer.write_midi(notes, midi_path)
+    return analyzer.notes_from_midi(midi_path)
+
+def run_case(path, tmp_dir):
+    """Runs the in-memory analysis path stage by stage. Returns (stages, summary)."""
+    stages = {}
+    _timed(stages, 'hash', analyzer.get_file_hash, path)
+    y, sr, y_model = _timed(stages, 'decode', analyzer.load_audio, path)
+    y_norm = y / (np.max(np.abs(y)) + 1e-9)
+    duration = len(y) / sr
+
+    spans = _timed(stages, 'rms', _gate, y_norm, sr)
+    _timed(stages, 'envelope', analyzer.generate_waveform_data, y_norm, sr)
+    notes = _timed(stages, 'transcription', analyzer.transcribe_spans, y_model, spans)
+    notes = _timed(stages, 'midi', _midi_round_trip, notes, os.path.join(tmp_dir, 'bench.mid'))
+    metrics = _timed(stages, 'merge', analyzer.calculate_metrics_from_notes, notes, duration)
+
+    summary = {
+        'duration': duration,
+        'transcribed_seconds': sum(min(end, duration) - start for start, end in spans),
+        'notes': len(notes['start']),
+        'keystrokes': metrics['keystrokes'],
+    }
+    return stages, summary
+
+def _best(runs):
+    """Per stage, the run with the lowest wall time."""
+    return {name: min((r[name] for r in runs), key=lambda t: t['wall']) for name in STAGES}
+
+def _environment():
+    from importlib import metadata
+
+    def version(package):
+        try:
+            return metadata.version(package)
+        except metadata.PackageNotFoundError:
+            return None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'analyzer_version': analyzer.ANALYZER_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': {p: version(p) for p in ('numpy', 'librosa', 'soundfile', 'soxr', 'tensorflow', 'basic-pitch')},
+    }
+
+def compare(report, baseline):
+    """Prints per-stage wall time ratios against a baseline report. Returns the number of regressions."""
+    regressions = 0
+    old_cases = {c['name']: c for c in baseline['cases']}
+    for case in report['cases']:
+        old = old_cases.get(case['name'])
+        if old is None or old['params'] != case['params']:
+            print(f"{case['name']}: not in baseline (or different parameters), skipped")
+            continue
+        cells = []
+        for name in STAGES:
+            before, after = old['stages'][name]['wall'], case['stages'][name]['wall']
+            ratio = after / before if before > 0 else float('inf')
+            slow = ratio > REGRESSION_RATIO and before >= REGRESSION_MIN_SECONDS
+            regressions += slow
+            cells.append(f"{name} {ratio:4.2f}x{' !' if slow else ''}")
+        print(f"{case['name']:<11} " + ', '.join(cells))
+    print(f"{regressions} regression(s) against {baseline['environment'].get('commit')} "
+          f"(> {REGRESSION_RATIO}x on stages >= {REGRESSION_MIN_SECONDS} s)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES), default=sorted(CASES))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every case duration')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case; the fastest run of each stage is kept')
+    parser.add_argument('--output', help='write the JSON report here (default: stdout only)')
+    parser.add_argument('--compare', metavar='REPORT', help='earlier JSON report to check for regressions')
+    parser.add_argument('--data-dir', help='keep rendered recordings here and reuse them across runs')
+    args = parser.parse_args()
+
+    report = {'environment': _environment(), 'cases': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or tmp
+
+        # Untimed run first: loads the model and librosa's lazily imported modules
+        run_case(make_recording(os.path.join(tmp, 'warmup.wav'), duration=2.0, sr=44100), tmp)
+
+        for name in args.cases:
+            params = dict(CASES[name], duration=CASES[name]['duration'] * args.scale)
+            path = os.path.join(data_dir, f"{name}_{params['duration']:g}s_{params['sr']}.wav")
+            if not os.path.exists(path):
+                make_recording(path, **params)
+
+            runs, summary = [], None
+            for _ in range(args.repeat):
+                stages, summary = run_case(path, tmp)
+                runs.append(stages)
+            best = _best(runs)
+            report['cases'].append({'name': name, 'params': params, 'summary': summary, 'stages': best})
+
+            total = sum(t['wall'] for t in best.values())
+            print(f"{name:<11} {params['duration']:>6g} s @ {params['sr']} Hz: total {total:7.2f} s  " +
+                  '  '.join(f"{stage} {best[stage]['wall']:.2f}" for stage in STAGES))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
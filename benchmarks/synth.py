@@ -0,0 +1,61 @@
+"""Deterministic synthetic piano-like recordings for benchmarks."""
+import os
+import numpy as np
+import soundfile as sf
+
+# Rendered in blocks so multi-hour files never sit in memory at once
+BLOCK_SECONDS = 10
+NOTE_SECONDS = 1.5
+
+def _note_schedule(duration, note_density, silence_ratio, rng):
+    """Returns (onsets, midi_pitches, amplitudes) for the whole recording."""
+    # Alternate playing / silent stretches so that `silence_ratio` of the time is idle
+    onsets = []
+    t = 0.0
+    while t < duration:
+        play = rng.uniform(20, 120)
+        rest = play * silence_ratio / max(1e-6, 1 - silence_ratio)
+        n = rng.poisson(note_density * play)
+        onsets.append(t + np.sort(rng.uniform(0, play, n)))
+        t += play + rest
+    onsets = np.concatenate(onsets) if onsets else np.zeros(0)
+    onsets = onsets[onsets < duration - 0.1]
+    pitches = rng.integers(36, 96, len(onsets))
+    amplitudes = rng.uniform(0.2, 0.9, len(onsets))
+    return onsets, pitches, amplitudes
+
+def make_recording(path, duration=60.0, sr=44100, note_density=4.0, silence_ratio=0.3, seed=0):
+    """
+    Writes a mono 16-bit WAV of `duration` seconds with decaying harmonic
+    tones at `note_density` notes per second while playing, and silent
+    gaps making up `silence_ratio` of the total time. Returns `path`.
+    """
+    rng = np.random.default_rng(seed)
+    onsets, pitches, amplitudes = _note_schedule(duration, note_density, silence_ratio, rng)
+    freqs = 440.0 * 2 ** ((pitches - 69) / 12)
+
+    n_total = int(duration * sr)
+    block = BLOCK_SECONDS * sr
+    note_len = int(NOTE_SECONDS * sr)
+    t_note = np.arange(note_len) / sr
+    decay = np.exp(-3.0 * t_note)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with sf.SoundFile(path, 'w', samplerate=sr, channels=1, subtype='PCM_16') as f:
+        for b_start in range(0, n_total, block):
+            b_end = min(n_total, b_start + block)
+            buf = rng.normal(0, 1e-4, b_end - b_start).astype(np.float32)  # room noise
+
+            first = np.searchsorted(onsets, (b_start - note_len) / sr)
+            last = np.searchsorted(onsets, b_end / sr)
+            for onset, freq, amp in zip(onsets[first:last], freqs[first:last], amplitudes[first:last]):
+                s = int(onset * sr)
+                lo, hi = max(s, b_start), min(s + note_len, b_end)
+                if lo >= hi:
+                    continue
+                t = t_note[lo - s:hi - s]
+                tone = np.sin(2 * np.pi * freq * t) + 0.4 * np.sin(4 * np.pi * freq * t) + 0.2 * np.sin(6 * np.pi * freq * t)
+                buf[lo - b_start:hi - b_start] += (0.25 * amp * tone * decay[lo - s:hi - s]).astype(np.float32)
+
+            f.write(np.clip(buf, -1.0, 1.0))
+    return path
@@ -56,6 +56,9 @@ def reset_and_reprocess():
     else:
         print("Archive 目录不存在。")
 
+    # 分析缓存 (instance/cache) 保留不动：内容未变的录音重跑时直接复用缓存，跳过模型识别
+    print("分析缓存 (instance/cache) 已保留，未变化的录音将跳过模型识别。")
+
     print("\n--- 重置完成 ---")
     print("请确保 app.py 正在运行 (或重启 app.py)，后台将自动开始分析 Uploads 中的文件。")
 
@@ -1,6 +1,10 @@
 // State
 let currentDate = new Date(); // The date currently being viewed for "Today's Card"
 let currentMonthDate = new Date(); // The month being viewed in Calendar
+let daySessions = []; // Sessions of the viewed day, kept current by /api/events
+const waveformCache = new Map(); // Envelope promises, so re-rendering the day doesn't refetch them
+const ingestJobs = new Map(); // filename -> latest queued/decoding/transcribing/failed event
+let monthRefreshTimer = null;
 
 document.addEventListener('DOMContentLoaded', () => {
     updateDateDisplay();
@@ -13,6 +17,8 @@ document.addEventListener('DOMContentLoaded', () => {
     // Event Listeners
     document.getElementById('prev-day').addEventListener('click', () => changeDate(-1));
     document.getElementById('next-day').addEventListener('click', () => changeDate(1));
+
+    connectEvents();
 });
 
 function formatDateRequest(date) {
@@ -52,6 +58,7 @@ function changeDate(delta) {
 
     currentDate = newDate;
     updateDateDisplay();
+    waveformCache.clear();
 
     const dateStr = formatDateRequest(currentDate);
     fetchStats(dateStr);
@@ -67,16 +74,33 @@ function changeDate(delta) {
 async function fetchStats(dateStr) {
     try {
         const response = await fetch(`/api/stats?date=${dateStr}`);
-        const data = await response.json();
-
-        document.getElementById('today-duration').textContent = `${(data.today_duration / 60).toFixed(1)} min`;
-        document.getElementById('today-keystrokes').textContent = data.today_keystrokes.toLocaleString();
-        document.getElementById('today-efficiency').textContent = `${Math.round(data.today_efficiency * 100)}%`;
+        renderStats(await response.json());
     } catch (error) {
         console.error('Error fetching stats:', error);
     }
 }
 
+function renderStats(data) {
+    document.getElementById('today-duration').textContent = `${(data.today_duration / 60).toFixed(1)} min`;
+    document.getElementById('today-keystrokes').textContent = data.today_keystrokes.toLocaleString();
+    document.getElementById('today-efficiency').textContent = `${Math.round(data.today_efficiency * 100)}%`;
+}
+
+// Same totals as /api/stats, from the sessions already on the page
+function statsFromSessions(sessions) {
+    let active = 0, keystrokes = 0, total = 0;
+    sessions.forEach(s => {
+        active += s.active_duration || 0;
+        keystrokes += s.keystrokes || 0;
+        total += s.total_duration || 0;
+    });
+    return {
+        today_duration: active,
+        today_keystrokes: keystrokes,
+        today_efficiency: total > 0 ? active / total : 0
+    };
+}
+
 async function fetchSessions(dateStr) {
     try {
         let url = '/api/sessions';
@@ -86,6 +110,39 @@ async function fetchSessions(dateStr) {
         const response = await fetch(url);
         const groups = await response.json();
 
+        daySessions = groups.flatMap(group => group.sessions);
+        renderSessions();
+    } catch (error) {
+        console.error('Error fetching sessions:', error);
+    }
+}
+
+// Same grouping as /api/sessions: sessions less than 30 minutes apart form one group
+function groupSessions(sessions) {
+    const groups = [];
+    const sorted = [...sessions].sort((a, b) => new Date(a.date) - new Date(b.date));
+    sorted.forEach(session => {
+        const start = new Date(session.date);
+        const end = new Date(start.getTime() + (session.total_duration || 0) * 1000);
+        const last = groups[groups.length - 1];
+        if (last && start - last.end_time < 30 * 60 * 1000) {
+            last.sessions.push(session);
+            if (end > last.end_time) last.end_time = end;
+        } else {
+            groups.push({ start_time: start, end_time: end, sessions: [session] });
+        }
+    });
+    groups.forEach(group => {
+        group.active_duration = group.sessions.reduce((sum, s) => sum + (s.active_duration || 0), 0);
+        group.keystrokes = group.sessions.reduce((sum, s) => sum + (s.keystrokes || 0), 0);
+    });
+    return groups;
+}
+
+function renderSessions() {
+    try {
+        const groups = groupSessions(daySessions);
+
         const container = document.getElementById('session-list');
         container.innerHTML = '';
 
@@ -138,6 +195,7 @@ async function fetchSessions(dateStr) {
                     <div class="waveform-meta">
                         <div style="font-weight:600; color:#333;">${mins} min</div>
                         <div style="font-size:11px; color:#999; margin-top:2px;">${session.keystrokes.toLocaleString()} 音</div>
+                        ${session.provisional ? '<div style="font-size:11px; color:#E57373; margin-top:2px;">● 录制中</div>' : ''}
                     </div>
                     <div class="waveform-container">
                         <canvas class="waveform-canvas"></canvas>
@@ -146,16 +204,161 @@ async function fetchSessions(dateStr) {
 
                 listContainer.appendChild(itemDiv);
 
-                // Render Canvas
+                // Render Canvas (measured once laid out, so only the level of detail it can show is fetched)
                 const canvas = itemDiv.querySelector('.waveform-canvas');
-                requestAnimationFrame(() => renderSparkline(canvas, session));
+                requestAnimationFrame(() => {
+                    const pixels = Math.round(canvas.getBoundingClientRect().width * (window.devicePixelRatio || 1));
+                    // A provisional session's waveform grows with each update
+                    const key = `${session.waveform_url}|${pixels}|${session.total_duration}`;
+                    if (!waveformCache.has(key)) {
+                        waveformCache.set(key, fetchWaveform(session.waveform_url, pixels));
+                    }
+                    waveformCache.get(key)
+                        .then(envelope => renderSparkline(canvas, session, envelope))
+                        .catch(e => console.error('Error fetching waveform:', e));
+                });
             });
 
             container.appendChild(groupDiv);
         });
 
     } catch (error) {
-        console.error('Error fetching sessions:', error);
+        console.error('Error rendering sessions:', error);
+    }
+}
+
+// Live updates from the background worker (server-sent events from /api/events)
+function connectEvents() {
+    if (!window.EventSource) return;
+    const source = new EventSource('/api/events');
+    let connected = false;
+
+    source.addEventListener('open', () => {
+        // After a reconnect, catch up on whatever was missed in between
+        if (connected) {
+            ingestJobs.clear();
+            const dateStr = formatDateRequest(currentDate);
+            fetchStats(dateStr);
+            fetchSessions(dateStr);
+        }
+        connected = true;
+    });
+
+    ['queued', 'decoding', 'transcribing'].forEach(name => {
+        source.addEventListener(name, e => {
+            const data = JSON.parse(e.data);
+            ingestJobs.set(data.file, data);
+            renderIngestStatus();
+        });
+    });
+
+    source.addEventListener('provisional', e => {
+        updateSession(JSON.parse(e.data).session);
+    });
+
+    source.addEventListener('saved', e => {
+        const data = JSON.parse(e.data);
+        ingestJobs.delete(data.file);
+        renderIngestStatus();
+        removeSession(data.replaces);
+        if (data.session) {
+            updateSession(data.session);
+            scheduleMonthRefresh(new Date(data.session.date));
+        }
+    });
+
+    source.addEventListener('discarded', e => {
+        const data = JSON.parse(e.data);
+        ingestJobs.delete(data.file);
+        renderIngestStatus();
+        if (data.hash) removeSession(data.hash);
+    });
+
+    source.addEventListener('failed', e => {
+        const data = JSON.parse(e.data);
+        ingestJobs.set(data.file, data);
+        renderIngestStatus();
+        // Shown for a while, then left to /admin
+        setTimeout(() => {
+            if (ingestJobs.get(data.file) === data) {
+                ingestJobs.delete(data.file);
+                renderIngestStatus();
+            }
+        }, 15000);
+    });
+}
+
+// Adds or replaces a session in the viewed day (dropping it if it no longer belongs there)
+function updateSession(session) {
+    daySessions = daySessions.filter(s => s.hash !== session.hash);
+    const onViewedDay = formatDateRequest(new Date(session.date)) === formatDateRequest(currentDate);
+    // Same noise filter as /api/sessions and /api/stats
+    if (onViewedDay && session.keystrokes >= 10) {
+        daySessions.push(session);
+    }
+    renderSessions();
+    renderStats(statsFromSessions(daySessions));
+}
+
+function removeSession(hash) {
+    if (!daySessions.some(s => s.hash === hash)) return;
+    daySessions = daySessions.filter(s => s.hash !== hash);
+    renderSessions();
+    renderStats(statsFromSessions(daySessions));
+}
+
+// The calendar is refreshed at most every few seconds while a backlog is being saved
+function scheduleMonthRefresh(date) {
+    if (date.getFullYear() !== currentMonthDate.getFullYear() || date.getMonth() !== currentMonthDate.getMonth()) return;
+    clearTimeout(monthRefreshTimer);
+    monthRefreshTimer = setTimeout(() => {
+        fetchMonthStats(currentMonthDate.getFullYear(), currentMonthDate.getMonth() + 1);
+    }, 3000);
+}
+
+function renderIngestStatus() {
+    const container = document.getElementById('ingest-status');
+    const labels = { queued: '排队中', decoding: '解码中', transcribing: '识别中', failed: '失败' };
+    const active = [];
+    let queued = 0;
+    ingestJobs.forEach(job => {
+        if (job.event === 'queued') queued++;
+        else active.push(job);
+    });
+
+    container.innerHTML = '';
+    container.style.display = active.length || queued ? '' : 'none';
+
+    active.forEach(job => {
+        const row = document.createElement('div');
+        row.className = 'ingest-item' + (job.event === 'failed' ? ' ingest-failed' : '');
+        let detail = '';
+        if (job.percent != null) {
+            detail = `${Math.round(job.percent)}%`;
+        } else if (job.event === 'failed' && job.job) {
+            detail = job.job.next_attempt_at
+                ? `${new Date(job.job.next_attempt_at).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })} 重试`
+                : '请在管理后台查看';
+        }
+        row.innerHTML = `
+            <span class="ingest-file"></span>
+            <span class="ingest-stage"></span>
+            <div class="ingest-bar"><div></div></div>
+        `;
+        // Filenames come from uploads and removable drives, so never as HTML
+        const file = row.querySelector('.ingest-file');
+        file.textContent = job.file;
+        file.title = job.file;
+        row.querySelector('.ingest-stage').textContent = `${labels[job.event] || job.event} ${detail}`;
+        row.querySelector('.ingest-bar div').style.width = `${Number(job.percent) || 0}%`;
+        container.appendChild(row);
+    });
+
+    if (queued) {
+        const row = document.createElement('div');
+        row.className = 'ingest-item ingest-queued';
+        row.textContent = `另有 ${queued} 个录音排队等待分析`;
+        container.appendChild(row);
     }
 }
 
@@ -239,8 +442,45 @@ function formatDuration(seconds) {
     return `${minutes.toFixed(1)} min`;
 }
 
+// Waveform blob: [version u8][rate u16][count u32] (little endian) + count x u8 amplitude (0-255)
+const WAVEFORM_HEADER_SIZE = 7;
+
+// The server picks the coarsest stored level with at least `width` samples over
+// [start, end] seconds (whole recording by default). envelope.start is the time
+// of the first sample.
+async function fetchWaveform(url, width, start, end) {
+    const params = new URLSearchParams();
+    if (width) params.set('width', Math.ceil(width));
+    if (start !== undefined) params.set('start', start);
+    if (end !== undefined) params.set('end', end);
+    const query = params.toString();
+
+    const response = await fetch(query ? `${url}?${query}` : url);
+    if (!response.ok) return null;
+    const envelope = decodeWaveform(await response.arrayBuffer());
+    if (envelope) envelope.start = parseFloat(response.headers.get('X-Waveform-Start')) || 0;
+    return envelope;
+}
+
+function decodeWaveform(buffer) {
+    const view = new DataView(buffer);
+    const version = view.getUint8(0);
+    if (version !== 1) {
+        console.warn(`Unsupported waveform format version ${version}`);
+        return null;
+    }
+    const rate = view.getUint16(1, true);
+    const count = view.getUint32(3, true);
+    const samples = new Uint8Array(buffer, WAVEFORM_HEADER_SIZE, count);
+
+    const envelope = new Float32Array(count);
+    for (let i = 0; i < count; i++) envelope[i] = samples[i] / 255;
+    envelope.rate = rate;
+    return envelope;
+}
+
 // Sparkline Renderer (Fixed Height, Full Width)
-function renderSparkline(canvas, session) {
+function renderSparkline(canvas, session, envelope) {
     const ctx = canvas.getContext('2d');
     const dpr = window.devicePixelRatio || 1;
     // Wait for layout? frame request handles it mostly.
@@ -255,7 +495,6 @@ function renderSparkline(canvas, session) {
     const centerY = height / 2;
     ctx.clearRect(0, 0, width, height);
 
-    const envelope = session.waveform;
     if (!envelope || envelope.length === 0) return;
 
     // 1. Draw Waveform (Gray)
@@ -0,0 +1,160 @@
+import os
+import ctypes
+import ctypes.util
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+# Watches the uploads folder so the background worker wakes up as soon as a file
+# arrives instead of polling. Uses Linux inotify through ctypes (no extra
+# dependency); elsewhere, or if inotify fails, the worker falls back to polling.
+
+# inotify event masks (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008 # A file opened for writing was closed (copy or recording finished)
+IN_MOVED_TO = 0x00000080    # A file was moved/renamed into the folder
+IN_IGNORED = 0x00008000     # The watch was removed (folder deleted or unmounted)
+IN_CLOEXEC = 0o2000000
+# Not IN_CREATE: a copy would be picked up while still being written. Recordings in
+# progress are found by the periodic rescan and then analyzed live.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+# struct inotify_event header: wd, mask, cookie, len (followed by len bytes of name)
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds between full folder scans: a safety net while inotify works, the only
+# way to notice new files when it doesn't
+RESCAN_SECONDS = 60
+POLL_SECONDS = 5
+
+def _inotify_watch(path, mask):
+    """Returns an inotify file descriptor watching `path` for `mask`."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+    fd = libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, os.strerror(errno))
+    return fd
+
+class UploadWatcher:
+    """
+    Wakes the ingest loop when files finish being written or are moved into
+    a folder. wake_future() completes on the next event, so it can be
+    waited on together with analysis futures (concurrent.futures.wait);
+    clear() re-arms it before each scan. rescan_interval is how long the loop
+    may sleep without an event.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.inotify = False
+        self._lock = threading.Lock()
+        self._wake = Future()
+        try:
+            fd = _inotify_watch(path, WATCH_MASK)
+        except Exception as e:
+            print(f"inotify unavailable ({e}), polling {path} every {POLL_SECONDS} s")
+            return
+        self.inotify = True
+        threading.Thread(target=self._read_events, args=(fd,), daemon=True).start()
+
+    @property
+    def rescan_interval(self):
+        return RESCAN_SECONDS if self.inotify else POLL_SECONDS
+
+    def wake_future(self):
+        with self._lock:
+            return self._wake
+
+    def clear(self):
+        """Re-arms wake_future after an event, before the folder is scanned."""
+        with self._lock:
+            if self._wake.done():
+                self._wake = Future()
+
+    def wake(self):
+        """Wakes the ingest loop now, e.g. after a job was requeued from outside it."""
+        with self._lock:
+            if not self._wake.done():
+                self._wake.set_result(True)
+
+    def _read_events(self, fd):
+        try:
+            while True:
+                buffer = os.read(fd, 64 * 1024)
+                pos = 0
+                while pos + EVENT_HEADER.size <= len(buffer):
+                    _, mask, _, name_len = EVENT_HEADER.unpack_from(buffer, pos)
+                    pos += EVENT_HEADER.size + name_len
+                    if mask & IN_IGNORED:
+                        raise OSError(f"watch on {self.path} was removed")
+                # The loop rescans the whole folder on wake-up, so names (and
+                # queue overflows) need no handling of their own
+                self.wake()
+        except Exception as e:
+            print(f"Upload watcher stopped ({e}), polling {self.path} every {POLL_SECONDS} s")
+            self.inotify = False
+            os.close(fd)
+            self.wake()
+
+class StabilityTracker:
+    """
+    Decides when uploaded files are fully written without sleeping on them:
+    each scan records every file's size and mtime, and a file is ready once
+    neither has changed for `stable_seconds`. Files whose mtime is already
+    that old when first seen (a backlog, or a finished copy) are ready at once.
+    `recording(path)` tells a recording in progress from a copy: only files it
+    is true for are reported GROWING; other growth is just PENDING.
+    """
+    READY = 'ready'
+    PENDING = 'pending' # New or recently changed; check again after next_check()
+    GROWING = 'growing' # Bigger than at the last scan, and still being recorded
+
+    def __init__(self, stable_seconds, recording=None):
+        self.stable_seconds = stable_seconds
+        self.recording = recording
+        self._seen = {} # name -> ((size, mtime_ns), monotonic time of last change)
+        self._ready = {} # name -> whether the last check found it ready
+
+    def check(self, name, path):
+        """Returns READY, PENDING or GROWING for a file (OSError if it's gone)."""
+        status = self._check(name, path)
+        self._ready[name] = status == self.READY
+        return status
+
+    def _check(self, name, path):
+        st = os.stat(path)
+        state = (st.st_size, st.st_mtime_ns)
+        now = time.monotonic()
+        previous = self._seen.get(name)
+
+        if previous is None:
+            if time.time() - st.st_mtime >= self.stable_seconds:
+                self._seen[name] = (state, now - self.stable_seconds)
+                return self.READY
+            self._seen[name] = (state, now)
+            return self.PENDING
+
+        if previous[0] != state:
+            self._seen[name] = (state, now)
+            # Only growth of a recording counts as being written; a copy or e.g. a
+            # header rewrite just restarts the clock
+            if state[0] > previous[0][0] and self.recording and self.recording(path):
+                return self.GROWING
+            return self.PENDING
+        return self.READY if now - previous[1] >= self.stable_seconds else self.PENDING
+
+    def prune(self, names):
+        """Forgets files that are no longer candidates (processed, removed or being analyzed)."""
+        names = set(names)
+        self._seen = {k: v for k, v in self._seen.items() if k in names}
+        self._ready = {k: v for k, v in self._ready.items() if k in names}
+
+    def next_check(self):
+        """Seconds until the first file that wasn't ready at its last check may be, or None."""
+        now = time.monotonic()
+        waits = [since + self.stable_seconds - now for name, (_, since) in self._seen.items() if not self._ready.get(name)]
+        return max(0.0, min(waits)) if waits else None